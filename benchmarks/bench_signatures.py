@@ -0,0 +1,57 @@
+"""
+Микробенчмарк подписей: старый вариант (ключ выводится на каждый вызов) против core.Signer.
+
+    python benchmarks/bench_signatures.py
+"""
+import hashlib
+import hmac
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456789:AAbenchmark-token-for-signatures")
+
+from core import BOT_TOKEN, signer  # noqa: E402
+
+N = 200_000
+CHAT_ID = -1001234567890
+USER_ID = 123456789
+DATA_CHECK_STRING = "auth_date=1700000000\nquery_id=AAH\nuser={\"id\":123456789,\"first_name\":\"Test\"}"
+
+
+def legacy_chat_sig(chat_id: int) -> str:
+    key = hashlib.sha256(BOT_TOKEN.encode("utf-8")).digest()
+    return hmac.new(key, str(chat_id).encode("utf-8"), hashlib.sha256).hexdigest()[:20]
+
+
+def legacy_user_sig(chat_id: int, user_id: int) -> str:
+    key = hashlib.sha256(BOT_TOKEN.encode("utf-8")).digest()
+    return hmac.new(key, f"{chat_id}:{user_id}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def legacy_webapp_hash(data_check_string: str) -> str:
+    secret_key = hmac.new(b"WebAppData", BOT_TOKEN.encode("utf-8"), hashlib.sha256).digest()
+    return hmac.new(secret_key, data_check_string.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def bench(name: str, legacy, cached):
+    assert legacy() == cached(), name
+    t_legacy = min(timeit.repeat(legacy, number=N, repeat=5)) / N * 1e9
+    t_cached = min(timeit.repeat(cached, number=N, repeat=5)) / N * 1e9
+    print(f"{name:<12} legacy {t_legacy:8.0f} ns/call   cached {t_cached:8.0f} ns/call   saved {t_legacy - t_cached:6.0f} ns ({(1 - t_cached / t_legacy) * 100:4.1f}%)")
+
+
+def main():
+    webapp_mac = signer._webapp_macs[0]
+    bench("chat_sig", lambda: legacy_chat_sig(CHAT_ID), lambda: signer.chat_sig(CHAT_ID))
+    bench("user_sig", lambda: legacy_user_sig(CHAT_ID, USER_ID), lambda: signer.user_sig(CHAT_ID, USER_ID))
+    bench(
+        "webapp_hash",
+        lambda: legacy_webapp_hash(DATA_CHECK_STRING),
+        lambda: signer._hexdigest(webapp_mac, DATA_CHECK_STRING.encode("utf-8")),
+    )
+
+
+if __name__ == "__main__":
+    main()
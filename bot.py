@@ -1,44 +1,67 @@
-import os
+import hashlib
 import json
 import asyncio
 import logging
 from datetime import datetime, timedelta
 from typing import Optional
 
-import aiosqlite
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import Command
 from aiogram.types import (
-    Message, PollAnswer,
+    Message, PollAnswer, ChatMemberUpdated,
     InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo, CallbackQuery,
-    ReplyKeyboardMarkup, KeyboardButton, FSInputFile
+    ReplyKeyboardMarkup, KeyboardButton, BufferedInputFile
 )
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramForbiddenError
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
 from core import (
     BOT_TOKEN,
     BOT_USERNAME,
     WEBAPP_URL,
     MINIAPP_LINK,
+    REMINDER_CONCURRENCY,
+    ICS_FILE_CACHE_SIZE,
+    CHAT_MEMBER_CACHE_SIZE,
+    CHAT_MEMBER_CACHE_TTL,
+    TELEGRAM_API_BASE,
+    CLAIM_TTL_SECONDS,
     TZ,
-    DB_PATH,
+    OPT_YES,
+    OPT_MAYBE,
     now_tz,
+    now_epoch,
+    to_epoch,
     format_dt,
     format_card,
     make_chat_sig,
     make_user_sig,
+    signer,
     with_qs,
     api_base_url,
     build_poll_link,
     make_ics,
+    event_description,
+    webcal_url,
+    chat_feed_url,
+    user_feed_url,
 )
-from db_schema import CREATE_SQL
+from db_pool import pool, init_db, close_db
+from changes import record_change, change_bus, change_log_compactor, CHANGE_CREATE, CHANGE_DELETE
+from scheduler import reminder_scheduler
+from outbound import outbound, outbound_priority, PRIORITY_REMINDER, PRIORITY_BULK
+from vote_buffer import vote_buffer
+from poll_index import poll_index
+from caching import TTLCache
+from outbox import outbox
+from lease import WORKER_ID
 
 logging.basicConfig(level=logging.INFO, force=True)
 
 OPTIONS = ["я в деле", "надо подумать", "точно не смогу"]
-OPT_YES, OPT_MAYBE, OPT_NO = 0, 1, 2
 
 REM_36H = "maybe_36h"
 REM_3H = "yes_3h"
@@ -46,21 +69,62 @@ REM_UNPIN_23 = "unpin_23"
 
 router = Router()
 
+# Уже загруженные в Telegram .ics: event_id -> (хэш полей события, file_id).
+# Повторная отправка того же события идёт по file_id, без загрузки файла.
+ics_file_cache = TTLCache(ICS_FILE_CACHE_SIZE, 7 * 24 * 3600)
+
+# Может ли бот закреплять сообщения: chat_id -> (allowed, reason)
+bot_pin_rights = TTLCache(CHAT_MEMBER_CACHE_SIZE, CHAT_MEMBER_CACHE_TTL)
+
+
+async def init_bot_state(bot: Bot):
+    async with pool.connection() as db:
+        await poll_index.load(db)
+    # профиль бота запрашиваем один раз, дальше bot.me() отдаёт его из памяти
+    me = await bot.me()
+    logging.info("bot identity: id=%s username=%s", me.id, me.username)
+
+
+def create_bot() -> Bot:
+    session = None
+    if TELEGRAM_API_BASE:
+        # свой Bot API сервер: локальный telegram-bot-api или фейковый для тестов
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_BASE))
+    bot = Bot(
+        token=BOT_TOKEN,
+        session=session,
+        default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN),
+    )
+    # все исходящие запросы идут через общий планировщик с лимитами Telegram
+    bot.session.middleware(outbound)
+    return bot
+
+
+def _pin_rights(member) -> tuple[bool, str]:
+    status = getattr(member, "status", "")
+    if status == "creator":
+        return True, "creator"
+    if status == "administrator":
+        if bool(getattr(member, "can_pin_messages", False)):
+            return True, "administrator_with_can_pin_messages"
+        return False, "administrator_without_can_pin_messages"
+    return False, f"status={status}"
+
 
 async def _can_bot_pin_messages(bot: Bot, chat_id: int) -> tuple[bool, str]:
+    cached = bot_pin_rights.get(chat_id)
+    # «нельзя» из кэша не верим: права могли выдать, а my_chat_member пришёл в другой процесс
+    if cached is not None and cached[0]:
+        return cached
     try:
-        me = await bot.get_me()
+        me = await bot.me()
         member = await bot.get_chat_member(chat_id=chat_id, user_id=me.id)
-        status = getattr(member, "status", "")
-        if status == "creator":
-            return True, "creator"
-        if status == "administrator":
-            if bool(getattr(member, "can_pin_messages", False)):
-                return True, "administrator_with_can_pin_messages"
-            return False, "administrator_without_can_pin_messages"
-        return False, f"status={status}"
     except Exception as e:
+        # ошибку не кэшируем: в следующий раз спросим снова
         return False, f"check_failed:{type(e).__name__}"
+    rights = _pin_rights(member)
+    bot_pin_rights.set(chat_id, rights)
+    return rights
 
 
 async def _pin_message_if_allowed(
@@ -94,6 +158,8 @@ async def _pin_message_if_allowed(
         )
         return True, "ok"
     except Exception as e:
+        # права могли отобрать: при повторе спросим getChatMember заново
+        bot_pin_rights.pop(chat_id)
         logging.warning(
             "pin %s failed: chat_id=%s message_id=%s error=%s",
             kind,
@@ -103,6 +169,7 @@ async def _pin_message_if_allowed(
         )
         return False, f"api_error:{type(e).__name__}"
 
+
 def start_payload(text: str) -> str:
     if not text:
         return ""
@@ -190,11 +257,6 @@ def kb_event_actions(event_id: int):
     return None
 
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript(CREATE_SQL)
-        await db.commit()
-
 async def create_or_replace_reminders(db, event_id: int, dt: datetime):
     dt_local = dt.astimezone(TZ)
     t36 = dt - timedelta(hours=34)
@@ -202,35 +264,51 @@ async def create_or_replace_reminders(db, event_id: int, dt: datetime):
     t_unpin = dt_local.replace(hour=23, minute=0, second=0, microsecond=0)
 
     await db.execute("DELETE FROM reminders WHERE event_id=?", (event_id,))
-    if t36 > now_tz():
-        await db.execute(
-            "INSERT OR IGNORE INTO reminders(event_id, kind, run_at_iso, sent) VALUES(?, ?, ?, 0)",
-            (event_id, REM_36H, t36.isoformat()),
-        )
-    if t3 > now_tz():
-        await db.execute(
-            "INSERT OR IGNORE INTO reminders(event_id, kind, run_at_iso, sent) VALUES(?, ?, ?, 0)",
-            (event_id, REM_3H, t3.isoformat()),
-        )
-    if t_unpin > now_tz():
-        await db.execute(
-            "INSERT OR IGNORE INTO reminders(event_id, kind, run_at_iso, sent) VALUES(?, ?, ?, 0)",
-            (event_id, REM_UNPIN_23, t_unpin.isoformat()),
-        )
+    reminder_scheduler.cancel_event(event_id)
+    for kind, run_at in ((REM_36H, t36), (REM_3H, t3), (REM_UNPIN_23, t_unpin)):
+        if run_at > now_tz():
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO reminders(event_id, kind, run_at_iso, run_at_epoch, sent) VALUES(?, ?, ?, ?, 0)",
+                (event_id, kind, run_at.isoformat(), to_epoch(run_at)),
+            )
+            if reminder_scheduler.active:
+                # без цикла планировщика в этом процессе куча только росла бы; его владелец узнает из БД
+                reminder_scheduler.schedule(cur.lastrowid, event_id, to_epoch(run_at))
+            await cur.close()
 
-async def get_due_reminders(db):
+async def claim_due_reminders(db, now: int) -> list[tuple[int, int, str, Optional[int]]]:
+    """
+    Атомарно забирает наступившие напоминания за этим воркером на CLAIM_TTL_SECONDS.
+    Параллельный воркер (другая реплика) те же строки уже не получит; claim упавшего воркера истекает.
+    """
     cur = await db.execute(
-        "SELECT id, event_id, kind FROM reminders WHERE sent=0 AND run_at_iso<=? ORDER BY run_at_iso ASC",
-        (now_tz().isoformat(),),
+        """
+        UPDATE reminders SET claimed_by=?, claimed_until=?
+        WHERE id IN (
+            SELECT id FROM reminders
+            WHERE sent=0 AND run_at_epoch<=? AND (claimed_until IS NULL OR claimed_until<?)
+        )
+        RETURNING id, event_id, kind, (SELECT chat_id FROM events WHERE events.id = reminders.event_id), run_at_epoch
+        """,
+        (WORKER_ID, now + CLAIM_TTL_SECONDS, now, now),
     )
     rows = await cur.fetchall()
     await cur.close()
-    return rows
+    # RETURNING не гарантирует порядок
+    rows.sort(key=lambda row: (row[4], row[0]))
+    return [row[:4] for row in rows]
+
+async def mark_reminders_sent(db, reminder_ids: list[int]):
+    sent_at = now_tz().isoformat()
+    await db.executemany(
+        "UPDATE reminders SET sent=1, sent_at_iso=?, claimed_by=NULL, claimed_until=NULL WHERE id=? AND claimed_by=?",
+        [(sent_at, reminder_id, WORKER_ID) for reminder_id in reminder_ids],
+    )
 
-async def mark_reminder_sent(db, reminder_id: int):
+async def release_reminder_claims(db):
     await db.execute(
-        "UPDATE reminders SET sent=1, sent_at_iso=? WHERE id=?",
-        (now_tz().isoformat(), reminder_id),
+        "UPDATE reminders SET claimed_by=NULL, claimed_until=NULL WHERE claimed_by=? AND sent=0",
+        (WORKER_ID,),
     )
 
 async def get_users_by_choice(db, poll_id: str, option_id: int):
@@ -261,112 +339,253 @@ def display_name(username: Optional[str], first_name: Optional[str], last_name:
 def mention(uid: int, name: str = "user") -> str:
     return f"[{md_escape(name)}](tg://user?id={uid})"
 
-async def reminders_worker(bot: Bot):
-    while True:
-        try:
-            async with aiosqlite.connect(DB_PATH) as db:
-                due = await get_due_reminders(db)
-                for reminder_id, event_id, kind in due:
-                    try:
-                        cur = await db.execute(
-                            "SELECT chat_id, poll_id, poll_message_id, card_message_id, dt_iso, title, cost, location, details "
-                            "FROM events WHERE id=?",
-                            (event_id,),
-                        )
-                        event = await cur.fetchone()
-                        await cur.close()
-                        if not event:
-                            await mark_reminder_sent(db, reminder_id)
-                            continue
-
-                        chat_id, poll_id, poll_msg_id, card_msg_id, dt_iso, title, cost, location, details = event
-                        dt = datetime.fromisoformat(dt_iso).astimezone(TZ)
-
-                        poll_link = build_poll_link(chat_id, poll_msg_id)
-
-                        if kind == REM_36H:
-                            users = await get_users_by_choice(db, poll_id, OPT_MAYBE)
-                            if users:
-                                mentions = ", ".join(
-                                    mention(uid, display_name(username, first_name, last_name))
-                                    for uid, username, first_name, last_name in users[:30]
-                                )
-                                more = f" …и ещё {len(users)-30}" if len(users) > 30 else ""
-                                text = (
-                                    f"⏳ До встречи осталось ~34 часа.\n{mentions}{more}\n"
-                                    f"**Вы как?** Переголосуйте, пожалуйста 🙂\n\n"
-                                    f"📅 **{title}**\n"
-                                    f"🕒 {format_dt(dt)}\n"
-                                    f"📍 {location}\n"
-                                    f"💸 {cost}"
-                                )
-                                if (details or "").strip():
-                                    text += f"\n\n📝 {details.strip()}"
-                                if poll_link:
-                                    text += f"\n\nОпрос: {poll_link}"
-                                try:
-                                    await bot.send_message(
-                                        chat_id,
-                                        text,
-                                        parse_mode=ParseMode.MARKDOWN,
-                                        reply_to_message_id=int(poll_msg_id),
-                                    )
-                                except Exception:
-                                    await bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN)
-
-                        elif kind == REM_3H:
-                            users = await get_users_by_choice(db, poll_id, OPT_YES)
-                            if users:
-                                mentions = ", ".join(
-                                    mention(uid, display_name(username, first_name, last_name))
-                                    for uid, username, first_name, last_name in users[:30]
-                                )
-                                more = f" …и ещё {len(users)-30}" if len(users) > 30 else ""
-                                text = (
-                                    f"🔔 Через ~3 часа встреча!\n{mentions}{more}\n\n"
-                                    f"📅 **{title}**\n"
-                                    f"🕒 {format_dt(dt)}\n"
-                                    f"📍 {location}\n"
-                                    f"💸 {cost}"
-                                )
-                                if (details or "").strip():
-                                    text += f"\n\n📝 {details.strip()}"
-                                if poll_link:
-                                    text += f"\n\nОпрос: {poll_link}"
-                                await bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN)
-                        elif kind == REM_UNPIN_23:
-                            for mid in (poll_msg_id, card_msg_id):
-                                if mid:
-                                    try:
-                                        await bot.unpin_chat_message(chat_id=chat_id, message_id=int(mid))
-                                    except Exception:
-                                        pass
-
-                        await mark_reminder_sent(db, reminder_id)
-                    except TelegramForbiddenError as e:
-                        logging.warning(
-                            "skip reminder due to forbidden: reminder_id=%s event_id=%s kind=%s error=%s",
-                            reminder_id,
-                            event_id,
-                            kind,
-                            type(e).__name__,
-                        )
-                        await mark_reminder_sent(db, reminder_id)
-                    except Exception:
-                        logging.exception(
-                            "failed processing reminder: reminder_id=%s event_id=%s kind=%s",
-                            reminder_id,
-                            event_id,
-                            kind,
-                        )
+async def send_reminder(bot: Bot, event_id: int, kind: str):
+    """Отправляет напоминание. Исключение — отправить не удалось, можно повторить."""
+    users = []
+    async with pool.connection() as db:
+        cur = await db.execute(
+            "SELECT chat_id, poll_id, poll_message_id, card_message_id, dt_iso, title, cost, location, details "
+            "FROM events WHERE id=?",
+            (event_id,),
+        )
+        event = await cur.fetchone()
+        await cur.close()
+        if not event:
+            return
+
+        chat_id, poll_id, poll_msg_id, card_msg_id, dt_iso, title, cost, location, details = event
+        if kind == REM_36H:
+            users = await get_users_by_choice(db, poll_id, OPT_MAYBE)
+        elif kind == REM_3H:
+            users = await get_users_by_choice(db, poll_id, OPT_YES)
+
+    dt = datetime.fromisoformat(dt_iso).astimezone(TZ)
+    poll_link = build_poll_link(chat_id, poll_msg_id)
+
+    if kind == REM_36H:
+        if users:
+            mentions = ", ".join(
+                mention(uid, display_name(username, first_name, last_name))
+                for uid, username, first_name, last_name in users[:30]
+            )
+            more = f" …и ещё {len(users)-30}" if len(users) > 30 else ""
+            text = (
+                f"⏳ До встречи осталось ~34 часа.\n{mentions}{more}\n"
+                f"**Вы как?** Переголосуйте, пожалуйста 🙂\n\n"
+                f"📅 **{title}**\n"
+                f"🕒 {format_dt(dt)}\n"
+                f"📍 {location}\n"
+                f"💸 {cost}"
+            )
+            if (details or "").strip():
+                text += f"\n\n📝 {details.strip()}"
+            if poll_link:
+                text += f"\n\nОпрос: {poll_link}"
+            try:
+                await bot.send_message(
+                    chat_id,
+                    text,
+                    parse_mode=ParseMode.MARKDOWN,
+                    reply_to_message_id=int(poll_msg_id),
+                )
+            except Exception:
+                await bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN)
 
+    elif kind == REM_3H:
+        if users:
+            mentions = ", ".join(
+                mention(uid, display_name(username, first_name, last_name))
+                for uid, username, first_name, last_name in users[:30]
+            )
+            more = f" …и ещё {len(users)-30}" if len(users) > 30 else ""
+            text = (
+                f"🔔 Через ~3 часа встреча!\n{mentions}{more}\n\n"
+                f"📅 **{title}**\n"
+                f"🕒 {format_dt(dt)}\n"
+                f"📍 {location}\n"
+                f"💸 {cost}"
+            )
+            if (details or "").strip():
+                text += f"\n\n📝 {details.strip()}"
+            if poll_link:
+                text += f"\n\nОпрос: {poll_link}"
+            await bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN)
+    elif kind == REM_UNPIN_23:
+        for mid in (poll_msg_id, card_msg_id):
+            if mid:
+                try:
+                    await bot.unpin_chat_message(chat_id=chat_id, message_id=int(mid))
+                except TelegramBadRequest:
+                    pass  # сообщение уже откреплено или удалено
+
+async def process_reminder(bot: Bot, reminder_id: int, event_id: int, kind: str) -> bool:
+    """True — напоминание отправлено (или отправлять нечего); False — отдать в outbox на повтор."""
+    try:
+        await send_reminder(bot, event_id, kind)
+        return True
+    except TelegramForbiddenError as e:
+        logging.warning(
+            "skip reminder due to forbidden: reminder_id=%s event_id=%s kind=%s error=%s",
+            reminder_id,
+            event_id,
+            kind,
+            type(e).__name__,
+        )
+        return True
+    except Exception:
+        logging.exception(
+            "failed processing reminder: reminder_id=%s event_id=%s kind=%s",
+            reminder_id,
+            event_id,
+            kind,
+        )
+        return False
+
+async def process_due_reminders(bot: Bot):
+    # голоса из буфера должны попасть в выборку «кто идёт / кто думает»
+    try:
+        await vote_buffer.flush()
+    except Exception:
+        pass
+
+    now = now_epoch()
+    async with pool.connection(write=True) as db:
+        due = await claim_due_reminders(db, now)
+        # чужие claims (в том числе упавшего воркера) перепланируем на их истечение
+        await reminder_scheduler.schedule_held(db, now, WORKER_ID)
+        await db.commit()
+    if not due:
+        return
+
+    # Разные чаты обрабатываем параллельно (не больше REMINDER_CONCURRENCY одновременно),
+    # внутри одного чата — строго по порядку run_at.
+    by_chat: dict[Optional[int], list[tuple[int, int, str]]] = {}
+    for reminder_id, event_id, kind, chat_id in due:
+        by_chat.setdefault(chat_id, []).append((reminder_id, event_id, kind))
+
+    semaphore = asyncio.Semaphore(REMINDER_CONCURRENCY)
+    sent_ids: list[int] = []
+    failed: list[tuple[int, int, str]] = []
+
+    async def run_chat(reminders: list[tuple[int, int, str]]):
+        async with semaphore:
+            with outbound_priority(PRIORITY_REMINDER):
+                for reminder_id, event_id, kind in reminders:
+                    if await process_reminder(bot, reminder_id, event_id, kind):
+                        sent_ids.append(reminder_id)
+                    else:
+                        failed.append((reminder_id, event_id, kind))
+
+    await asyncio.gather(*(run_chat(reminders) for reminders in by_chat.values()))
+
+    if sent_ids or failed:
+        # Неотправленные напоминания передаём в outbox (повторы с паузой и лимитом попыток)
+        # в той же транзакции, где напоминание помечается обработанным.
+        async with pool.connection(write=True) as db:
+            for reminder_id, event_id, kind in failed:
+                await outbox.enqueue(
+                    db,
+                    "reminder",
+                    {"event_id": event_id, "kind": kind},
+                    dedup_key=f"reminder:{reminder_id}",
+                    delay=int(outbox.backoff_base),
+                )
+            await mark_reminders_sent(db, sent_ids + [reminder_id for reminder_id, _, _ in failed])
+            await db.commit()
+        if failed:
+            outbox.notify()
+
+async def reminders_worker(bot: Bot, resync_interval: Optional[float] = None):
+    try:
+        async with pool.connection() as db:
+            await reminder_scheduler.load(db)
+        await reminder_scheduler.run(lambda: process_due_reminders(bot), resync_interval)
+    finally:
+        reminder_scheduler.stop()
+        # при остановке отдаём недоотправленные напоминания другим репликам сразу, не ждём истечения claim
+        try:
+            async with pool.connection(write=True) as db:
+                await release_reminder_claims(db)
                 await db.commit()
         except Exception:
-            logging.exception("reminders_worker error")
-        await asyncio.sleep(30)
+            logging.exception("failed to release reminder claims")
+
+
+async def outbox_worker(bot: Bot, poll_interval: Optional[float] = None):
+    await outbox.run(bot, poll_interval)
+
+
+# Действия outbox. Исключение — повторить позже (кроме постоянных ошибок Telegram, см. outbox.py).
+
+@outbox.handler("reminder")
+async def _outbox_reminder(bot: Bot, payload: dict):
+    with outbound_priority(PRIORITY_REMINDER):
+        await send_reminder(bot, payload["event_id"], payload["kind"])
+
+
+@outbox.handler("edit_card")
+async def _outbox_edit_card(bot: Bot, payload: dict):
+    # карточку собираем из актуальной записи: несколько правок подряд дадут одно редактирование
+    async with pool.connection() as db:
+        cur = await db.execute(
+            "SELECT chat_id, card_message_id, dt_iso, title, cost, location, details FROM events WHERE id=?",
+            (payload["event_id"],),
+        )
+        row = await cur.fetchone()
+        await cur.close()
+    if not row or not row[1]:
+        return
+    chat_id, card_mid, dt_iso, title, cost, location, details = row
+    dt = datetime.fromisoformat(dt_iso).astimezone(TZ)
+    await bot.edit_message_text(
+        chat_id=chat_id,
+        message_id=int(card_mid),
+        text=format_card(dt, title, cost, location, details),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=None,
+    )
+
+
+@outbox.handler("send_ics")
+async def _outbox_send_ics(bot: Bot, payload: dict):
+    await _send_ics_to_chat(
+        bot,
+        payload["chat_id"],
+        payload["event_id"],
+        reply_to_message_id=payload.get("reply_to_message_id"),
+    )
+
+
+@outbox.handler("pin_message")
+async def _outbox_pin_message(bot: Bot, payload: dict):
+    # по действию на сообщение: повтор после сбоя не закрепит заново (и не оповестит чат) уже закреплённое
+    kind = payload["kind"]
+    ok, reason = await _pin_message_if_allowed(
+        bot,
+        payload["chat_id"],
+        payload["message_id"],
+        kind=kind,
+        disable_notification=payload["silent"],
+    )
+    if reason.startswith(("api_error:", "check_failed:")):
+        raise RuntimeError(f"pin {kind}: {reason}")
+    if not ok and payload.get("notify_chat_id"):
+        await bot.send_message(
+            payload["notify_chat_id"],
+            f"⚠️ Не удалось закрепить {'опрос' if kind == 'poll' else 'карточку'} в чате: {reason}",
+        )
+
+
+@outbox.handler("delete_messages")
+async def _outbox_delete_messages(bot: Bot, payload: dict):
+    for mid in payload["message_ids"]:
+        try:
+            await bot.delete_message(payload["chat_id"], int(mid))
+        except TelegramBadRequest:
+            pass  # уже удалено
 
 async def delete_event(bot: Bot, event_id: int, actor_user_id: int) -> str:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.connection(write=True) as db:
         cur = await db.execute(
             "SELECT chat_id, poll_message_id, card_message_id, poll_id, creator_user_id FROM events WHERE id=?",
             (event_id,),
@@ -383,17 +602,29 @@ async def delete_event(bot: Bot, event_id: int, actor_user_id: int) -> str:
         await db.execute("DELETE FROM reminders WHERE event_id=?", (event_id,))
         await db.execute("DELETE FROM votes WHERE poll_id=?", (poll_id,))
         await db.execute("DELETE FROM events WHERE id=?", (event_id,))
+        change = await record_change(db, chat_id, event_id, CHANGE_DELETE)
+        await outbox.enqueue(
+            db,
+            "delete_messages",
+            {"chat_id": chat_id, "message_ids": [mid for mid in (card_msg_id, poll_msg_id) if mid]},
+            dedup_key=f"delete_messages:{event_id}",
+        )
         await db.commit()
-
-    for mid in [card_msg_id, poll_msg_id]:
-        if mid:
-            try:
-                await bot.delete_message(chat_id, int(mid))
-            except Exception:
-                pass
+    change_bus.publish(change)
+    outbox.notify()
+    reminder_scheduler.cancel_event(event_id)
+    poll_index.discard(poll_id)
+    ics_file_cache.pop(event_id)
 
     return "Удалено ✅"
 
+@router.my_chat_member()
+async def on_my_chat_member(update: ChatMemberUpdated):
+    # права бота в чате изменились — берём их прямо из апдейта, без getChatMember
+    rights = _pin_rights(update.new_chat_member)
+    bot_pin_rights.set(update.chat.id, rights)
+    logging.info("bot membership changed: chat_id=%s rights=%s", update.chat.id, rights[1])
+
 @router.message(Command("start"))
 async def cmd_start(message: Message):
     payload = start_payload(message.text)
@@ -435,7 +666,7 @@ async def cmd_new(message: Message, bot: Bot):
     try:
         bot_username = BOT_USERNAME
         if not bot_username:
-            me = await bot.get_me()
+            me = await bot.me()
             bot_username = me.username or ""
         if not bot_username:
             await message.answer("Не могу получить username бота для ссылки.")
@@ -487,44 +718,36 @@ async def on_webapp_data(message: Message, bot: Bot):
     if data.get("action") == "edited_via_api":
         event_id = int(data.get("event_id"))
 
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with pool.connection(write=True) as db:
             cur = await db.execute(
-                "SELECT chat_id, card_message_id, dt_iso, title, cost, location, details FROM events WHERE id=?",
+                "SELECT chat_id, poll_id, card_message_id, dt_iso, title, cost, location, details FROM events WHERE id=?",
                 (event_id,),
             )
             row = await cur.fetchone()
             await cur.close()
-            if not row:
-                await message.answer("Событие не найдено.")
-                return
-
-            chat_id, card_mid, dt_iso, title, cost, location, details = row
-            dt = datetime.fromisoformat(dt_iso).astimezone(TZ)
-
-            await create_or_replace_reminders(db, event_id, dt)
-            await db.commit()
-
-        try:
-            if card_mid:
-                await bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=int(card_mid),
-                    text=format_card(dt, title, cost, location, details),
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=None,
+            if row:
+                chat_id, poll_id, card_mid, dt_iso, title, cost, location, details = row
+                dt = datetime.fromisoformat(dt_iso).astimezone(TZ)
+
+                await create_or_replace_reminders(db, event_id, dt)
+                # карточку и .ics в чате обновит воркер outbox
+                await outbox.enqueue(db, "edit_card", {"event_id": event_id}, dedup_key=f"edit_card:{event_id}")
+                await outbox.enqueue(
+                    db,
+                    "send_ics",
+                    {"chat_id": chat_id, "event_id": event_id, "reply_to_message_id": int(card_mid) if card_mid else None},
+                    dedup_key=f"send_ics:{event_id}",
                 )
-        except Exception:
-            pass
-
-        try:
-            await _send_ics_to_chat(
-                bot,
-                chat_id,
-                event_id,
-                reply_to_message_id=int(card_mid) if card_mid else None,
-            )
-        except Exception:
-            pass
+                await db.commit()
+        # ответ — уже без блокировки записи: запрос к Telegram может ждать лимитер
+        if not row:
+            await message.answer("Событие не найдено.")
+            return
+        outbox.notify()
+        ics_file_cache.pop(event_id)
+        if poll_id:
+            # встречу могли перенести — сдвигаем и срок приёма ответов
+            poll_index.add(poll_id, to_epoch(dt))
 
         await message.answer("✅ Обновил событие.")
         return
@@ -554,7 +777,7 @@ async def on_webapp_data(message: Message, bot: Bot):
             await message.answer("Некорректный chat_id. Открой форму кнопкой из нужного чата.")
             return
 
-        if make_chat_sig(target_chat_id) != str(sig):
+        if not signer.verify_chat_sig(target_chat_id, str(sig)):
             logging.warning("bad chat signature for chat_id=%s", target_chat_id)
             await message.answer("Подпись не совпала. Открой форму кнопкой из нужного чата и попробуй ещё раз.")
             return
@@ -584,7 +807,7 @@ async def on_webapp_data(message: Message, bot: Bot):
             await message.answer("Похоже, это время уже в прошлом.")
             return
 
-        # 3) Публикуем карточку в целевом чате
+        # 3) Публикуем карточку, затем опрос (порядок важен: опрос должен стоять под карточкой)
         card_msg = await bot.send_message(
             target_chat_id,
             format_card(dt, title, cost, location, details),
@@ -601,16 +824,10 @@ async def on_webapp_data(message: Message, bot: Bot):
             allows_multiple_answers=False,
         )
         logging.info("poll sent: chat_id=%s poll_id=%s message_id=%s", target_chat_id, poll_msg.poll.id, poll_msg.message_id)
-        poll_pin_ok, poll_pin_reason = await _pin_message_if_allowed(
-            bot,
-            target_chat_id,
-            poll_msg.message_id,
-            kind="poll",
-        )
 
-        # 5) Сохраняем в БД и планируем напоминания
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
+        # 5) Сохраняем в БД и планируем напоминания — после этого встреча создана
+        async with pool.connection(write=True) as db:
+            cur = await db.execute(
                 """
                 INSERT INTO events(
                     chat_id,
@@ -619,13 +836,15 @@ async def on_webapp_data(message: Message, bot: Bot):
                     card_message_id,
                     creator_user_id,
                     dt_iso,
+                    dt_utc_epoch,
                     title,
                     cost,
                     location,
                     details,
-                    created_at_iso
+                    created_at_iso,
+                    updated_at_epoch
                 )
-                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """,
                 (
                     target_chat_id,
@@ -634,64 +853,53 @@ async def on_webapp_data(message: Message, bot: Bot):
                     card_msg.message_id,
                     message.from_user.id if message.from_user else None,
                     dt.isoformat(),
+                    to_epoch(dt),
                     title,
                     cost,
                     location,
                     details,
                     now_tz().isoformat(),
+                    now_epoch(),
                 ),
             )
-
-            cur = await db.execute(
-                "SELECT id FROM events WHERE poll_id=?",
-                (poll_msg.poll.id,)
-            )
-            row = await cur.fetchone()
+            event_id = cur.lastrowid
             await cur.close()
 
-            event_id = row[0]
-
             await create_or_replace_reminders(db, event_id, dt)
+            change = await record_change(db, target_chat_id, event_id, CHANGE_CREATE)
+            # 6) Закреп и .ics — через outbox, пользователю отвечаем сразу
+            # карточку закрепляем на секунду позже опроса, чтобы она оказалась сверху
+            for kind, pin_mid, silent, delay in (
+                ("poll", poll_msg.message_id, False, 0),
+                ("card", card_msg.message_id, True, 1),
+            ):
+                await outbox.enqueue(
+                    db,
+                    "pin_message",
+                    {
+                        "chat_id": target_chat_id,
+                        "message_id": pin_mid,
+                        "kind": kind,
+                        "silent": silent,
+                        "notify_chat_id": message.chat.id,
+                    },
+                    dedup_key=f"pin:{event_id}:{pin_mid}",
+                    delay=delay,
+                )
+            await outbox.enqueue(
+                db,
+                "send_ics",
+                {"chat_id": target_chat_id, "event_id": event_id},
+                dedup_key=f"send_ics:{event_id}",
+            )
             await db.commit()
+        change_bus.publish(change)
+        outbox.notify()
+        poll_index.add(poll_msg.poll.id, to_epoch(dt))
         logging.info("event saved: event_id=%s chat_id=%s", event_id, target_chat_id)
 
-        # 6) Добавляем кнопки управления на карточку
-        try:
-            await bot.edit_message_reply_markup(
-                chat_id=target_chat_id,
-                message_id=card_msg.message_id,
-                reply_markup=None,
-            )
-        except Exception:
-            pass
-
-        # 7) Автозакреп карточки
-        card_pin_ok, card_pin_reason = await _pin_message_if_allowed(
-            bot,
-            target_chat_id,
-            card_msg.message_id,
-            kind="card",
-            disable_notification=True,
-        )
-
-        # 7.1) Отправляем .ics в чат группы
-        try:
-            await _send_ics_to_chat(bot, target_chat_id, event_id)
-        except Exception:
-            pass
-
-        # 8) Сообщение пользователю (в том чате, где он открыл mini app)
+        # 7) Сообщение пользователю (в том чате, где он открыл mini app)
         await message.answer("✅ Встреча создана. Опрос отправлен в чат 👇")
-        pin_failures = []
-        if not poll_pin_ok:
-            pin_failures.append(f"опрос: {poll_pin_reason}")
-        if not card_pin_ok:
-            pin_failures.append(f"карточка: {card_pin_reason}")
-        if pin_failures:
-            await message.answer(
-                "⚠️ Не удалось закрепить сообщения в чате.\n"
-                + "\n".join(pin_failures)
-            )
         return
 
     await message.answer("Неизвестное действие.")
@@ -704,31 +912,17 @@ async def on_poll_answer(poll_answer: PollAnswer):
     if not user:
         return
 
+    if not poll_index.accepts(poll_id):
+        return
+
     option_id: Optional[int]
     if not poll_answer.option_ids:
         option_id = None
     else:
         option_id = int(poll_answer.option_ids[0])
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT 1 FROM events WHERE poll_id=?", (poll_id,))
-        ok = await cur.fetchone()
-        await cur.close()
-        if not ok:
-            return
-
-        await db.execute(
-            "INSERT INTO votes(poll_id, user_id, option_id, updated_at_iso) VALUES(?, ?, ?, ?) "
-            "ON CONFLICT(poll_id, user_id) DO UPDATE SET option_id=excluded.option_id, updated_at_iso=excluded.updated_at_iso",
-            (poll_id, user.id, option_id, now_tz().isoformat()),
-        )
-        await db.execute(
-            "INSERT INTO users(user_id, username, first_name, last_name, updated_at_iso) VALUES(?, ?, ?, ?, ?) "
-            "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name, "
-            "last_name=excluded.last_name, updated_at_iso=excluded.updated_at_iso",
-            (user.id, user.username, user.first_name, user.last_name, now_tz().isoformat()),
-        )
-        await db.commit()
+    # запись в БД — пачкой из буфера (см. vote_buffer)
+    vote_buffer.add(poll_id, user.id, option_id, user.username, user.first_name, user.last_name)
 
 @router.callback_query(F.data.startswith("event:del:"))
 async def on_event_delete(cb: CallbackQuery, bot: Bot):
@@ -747,7 +941,7 @@ async def _send_ics(
     allow_chat_link: bool = False,
     reply_to_message_id: Optional[int] = None,
 ):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.connection() as db:
         cur = await db.execute(
             "SELECT chat_id, dt_iso, title, cost, location, details FROM events WHERE id=?",
             (event_id,),
@@ -763,12 +957,9 @@ async def _send_ics(
     event_chat_id, dt_iso, title, cost, location, details = row
     dt = datetime.fromisoformat(dt_iso).astimezone(TZ)
 
-    description = f"Стоимость: {cost}"
-    if (details or "").strip():
-        description += f"\n\n{details.strip()}"
-
     ics_link = ""
     webcal_link = ""
+    feed_link = ""
     api_base = api_base_url()
     if api_base:
         if user_id is not None:
@@ -781,10 +972,11 @@ async def _send_ics(
             chat_sig = make_chat_sig(int(event_chat_id))
             ics_link = f"{api_base}/api/calendar/ics?event_id={event_id}&chat_sig={chat_sig}"
 
-        if ics_link.startswith("https://"):
-            webcal_link = "webcal://" + ics_link[len("https://"):]
-        elif ics_link.startswith("http://"):
-            webcal_link = "webcal://" + ics_link[len("http://"):]
+        webcal_link = webcal_url(ics_link)
+        if user_id is not None:
+            feed_link = webcal_url(user_feed_url(int(user_id)))
+        elif allow_chat_link:
+            feed_link = webcal_url(chat_feed_url(int(event_chat_id)))
 
     if ics_link:
         caption += (
@@ -793,35 +985,52 @@ async def _send_ics(
         )
     if webcal_link:
         caption += f"\nИли откройте [webcal-ссылку]({webcal_link})."
+    if feed_link and user_id is not None:
+        caption += f"\n\nВсе квизы, на которые ты идёшь: [подписаться на календарь]({feed_link})."
+    elif feed_link:
+        caption += f"\n\nВсе квизы чата сразу: [подписаться на календарь]({feed_link})."
+
+    description = event_description(cost, details)
+    # DTSTAMP в файле меняется при каждой сборке, поэтому ключ — хэш самих полей события
+    content_hash = hashlib.sha256(
+        "\x1f".join((dt_iso, title, location, description)).encode("utf-8")
+    ).hexdigest()
+    cached = ics_file_cache.get(event_id)
+    file_id = cached[1] if cached is not None and cached[0] == content_hash else None
 
-    ics_text = make_ics(dt, title, location, description)
-    filename = None
     try:
-        import tempfile
-
-        with tempfile.NamedTemporaryFile("w", suffix=".ics", delete=False, encoding="utf-8") as f:
-            f.write(ics_text)
-            filename = f.name
-
-        await bot.send_document(
-            chat_id=chat_id,
-            document=FSInputFile(filename),
-            caption=caption,
-            parse_mode=ParseMode.MARKDOWN,
-            reply_to_message_id=reply_to_message_id,
-        )
+        # .ics — фоновая доставка, пропускаем вперёд напоминания
+        with outbound_priority(PRIORITY_BULK):
+            if file_id:
+                try:
+                    await bot.send_document(
+                        chat_id=chat_id,
+                        document=file_id,
+                        caption=caption,
+                        parse_mode=ParseMode.MARKDOWN,
+                        reply_to_message_id=reply_to_message_id,
+                    )
+                    return
+                except TelegramBadRequest:
+                    logging.warning("cached ics file_id rejected: event_id=%s", event_id)
+                    ics_file_cache.pop(event_id)
+
+            ics_text = make_ics(dt, title, location, description)
+            sent = await bot.send_document(
+                chat_id=chat_id,
+                document=BufferedInputFile(ics_text.encode("utf-8"), filename=f"event_{event_id}.ics"),
+                caption=caption,
+                parse_mode=ParseMode.MARKDOWN,
+                reply_to_message_id=reply_to_message_id,
+            )
+        if sent.document:
+            ics_file_cache.set(event_id, (content_hash, sent.document.file_id))
     except TelegramForbiddenError:
         if context_message:
             await context_message.answer("Я не могу написать тебе в личку. Открой бота и нажми /start, затем повтори.")
         else:
             # если нет контекста — молча
             pass
-    finally:
-        if filename:
-            try:
-                os.unlink(filename)
-            except Exception:
-                pass
 
 async def _send_ics_to_user(bot: Bot, user_id: int, event_id: int, context_message: Optional[Message] = None):
     await _send_ics(
@@ -867,20 +1076,31 @@ async def on_event_ics(cb: CallbackQuery, bot: Bot):
 async def main():
     await init_db()
 
-    from aiogram.client.default import DefaultBotProperties
-
-    bot = Bot(
-        token=BOT_TOKEN,
-        default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)
-    )
+    bot = create_bot()
+    await init_bot_state(bot)
 
     dp = Dispatcher()
     dp.include_router(router)
 
-    asyncio.create_task(reminders_worker(bot))
+    workers = [
+        asyncio.create_task(reminders_worker(bot)),
+        asyncio.create_task(outbox_worker(bot)),
+        asyncio.create_task(change_log_compactor()),
+    ]
 
     logging.info("Bot started")
-    await dp.start_polling(bot)
+    try:
+        # polling не работает, пока у бота висит webhook (например, после BOT_MODE=webhook в run.py)
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await vote_buffer.close()
+        await bot.session.close()
+        # потоки aiosqlite не демонические: без закрытия пула процесс не завершится
+        await close_db()
 
 
 
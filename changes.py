@@ -0,0 +1,210 @@
+import asyncio
+import logging
+from typing import Callable, NamedTuple, Optional
+
+from core import CHANGE_LOG_RETENTION_SECONDS, CHANGE_LOG_COMPACT_SECONDS, now_epoch
+from db_pool import pool
+
+CHANGE_CREATE = "create"
+CHANGE_UPDATE = "update"
+CHANGE_DELETE = "delete"
+CHANGE_VOTE = "vote"  # голос за событие (в журнале — с user_id проголосовавшего)
+
+
+class ChatChange(NamedTuple):
+    chat_id: int
+    version: int  # для CHANGE_VOTE — vote_version
+    event_id: int
+    action: str  # CHANGE_CREATE | CHANGE_UPDATE | CHANGE_DELETE | CHANGE_VOTE
+
+
+async def bump_chat_version(db, chat_id: int) -> int:
+    """
+    Отмечает изменение событий чата. Вызывается в той же транзакции, что и сама запись,
+    поэтому версия растёт ровно тогда, когда изменение закоммичено.
+    """
+    cur = await db.execute(
+        "INSERT INTO chat_versions(chat_id, version, updated_at_epoch) VALUES (?, 1, ?) "
+        "ON CONFLICT(chat_id) DO UPDATE SET version=version+1, updated_at_epoch=excluded.updated_at_epoch "
+        "RETURNING version",
+        (chat_id, now_epoch()),
+    )
+    (version,) = await cur.fetchone()
+    await cur.close()
+    return version
+
+
+async def record_change(db, chat_id: int, event_id: int, action: str) -> ChatChange:
+    """
+    Изменение события: версия чата + запись в журнал, в транзакции вызывающего.
+    Возвращённый ChatChange публикуется в change_bus после commit.
+    """
+    version = await bump_chat_version(db, chat_id)
+    await db.execute(
+        "INSERT INTO change_log(chat_id, event_id, action, created_at_epoch) VALUES (?, ?, ?, ?)",
+        (chat_id, event_id, action, now_epoch()),
+    )
+    return ChatChange(chat_id, version, event_id, action)
+
+
+async def record_vote_changes(db, votes: list[tuple[str, int]]) -> list[ChatChange]:
+    """
+    Голоса (poll_id, user_id), записанные в этой транзакции: vote_version их чатов и журнал.
+    Возвращает по ChatChange на событие — для change_bus после commit. Чужие опросы пропускаются.
+    """
+    poll_ids = list({poll_id for poll_id, _ in votes})
+    cur = await db.execute(
+        f"SELECT poll_id, id, chat_id FROM events WHERE poll_id IN ({','.join('?' * len(poll_ids))})",
+        poll_ids,
+    )
+    events = {poll_id: (event_id, chat_id) for poll_id, event_id, chat_id in await cur.fetchall()}
+    await cur.close()
+    if not events:
+        return []
+
+    versions = {}
+    for chat_id in sorted({chat_id for _, chat_id in events.values()}):
+        versions[chat_id] = await bump_vote_version(db, chat_id)
+    now = now_epoch()
+    await db.executemany(
+        "INSERT INTO change_log(chat_id, event_id, action, user_id, created_at_epoch) VALUES (?, ?, ?, ?, ?)",
+        [
+            (events[poll_id][1], events[poll_id][0], CHANGE_VOTE, user_id, now)
+            for poll_id, user_id in votes
+            if poll_id in events
+        ],
+    )
+    return [
+        ChatChange(chat_id, versions[chat_id], event_id, CHANGE_VOTE)
+        for event_id, chat_id in sorted(events.values())
+    ]
+
+
+async def bump_vote_version(db, chat_id: int) -> int:
+    """
+    Отмечает изменение голосов в чате. Тоже в транзакции записи голосов.
+    version не трогаем: список событий от голосов не меняется.
+    """
+    cur = await db.execute(
+        "INSERT INTO chat_versions(chat_id, version, vote_version, updated_at_epoch) VALUES (?, 0, 1, ?) "
+        "ON CONFLICT(chat_id) DO UPDATE SET vote_version=vote_version+1 "
+        "RETURNING vote_version",
+        (chat_id, now_epoch()),
+    )
+    (vote_version,) = await cur.fetchone()
+    await cur.close()
+    return vote_version
+
+
+async def get_chat_version(db, chat_id: int) -> tuple[int, int]:
+    """(version, updated_at_epoch); (0, 0), если в чате ещё ничего не менялось."""
+    cur = await db.execute("SELECT version, updated_at_epoch FROM chat_versions WHERE chat_id=?", (chat_id,))
+    row = await cur.fetchone()
+    await cur.close()
+    return (row[0], row[1]) if row else (0, 0)
+
+
+async def get_chat_versions(db, chat_id: int) -> tuple[int, int]:
+    """(version, vote_version) — всё, от чего зависит список событий чата с голосами."""
+    cur = await db.execute("SELECT version, vote_version FROM chat_versions WHERE chat_id=?", (chat_id,))
+    row = await cur.fetchone()
+    await cur.close()
+    return (row[0], row[1]) if row else (0, 0)
+
+
+async def get_log_position(db, chat_id: int) -> tuple[int, int]:
+    """(seq последней записи журнала по чату, log_floor). Записи с seq <= log_floor уже удалены."""
+    cur = await db.execute(
+        "SELECT COALESCE((SELECT MAX(seq) FROM change_log WHERE chat_id=?), 0), "
+        "COALESCE((SELECT log_floor FROM chat_versions WHERE chat_id=?), 0)",
+        (chat_id, chat_id),
+    )
+    position, floor = await cur.fetchone()
+    await cur.close()
+    # после компактизации записей чата может не остаться вовсе — позиция тогда log_floor
+    return max(position, floor), floor
+
+
+async def read_changes(db, chat_id: int, since: int, user_id: Optional[int]) -> list[tuple[int, str]]:
+    """(event_id, action) после since по порядку; голоса — только пользователя user_id."""
+    cur = await db.execute(
+        "SELECT event_id, action FROM change_log WHERE chat_id=? AND seq > ? "
+        "AND (action != ? OR user_id = ?) ORDER BY seq",
+        (chat_id, since, CHANGE_VOTE, user_id),
+    )
+    rows = await cur.fetchall()
+    await cur.close()
+    return rows
+
+
+async def compact_change_log(retention: int) -> int:
+    """Удаляет записи старше retention секунд, сдвигая log_floor их чатов. Возвращает число удалённых."""
+    cutoff = now_epoch() - retention
+    async with pool.connection(write=True) as db:
+        # seq растёт вместе со временем: первая свежая запись — граница, всё до неё старое
+        cur = await db.execute(
+            "SELECT seq FROM change_log WHERE created_at_epoch >= ? ORDER BY seq LIMIT 1", (cutoff,)
+        )
+        row = await cur.fetchone()
+        await cur.close()
+        if row is None:
+            cur = await db.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM change_log")
+            row = await cur.fetchone()
+            await cur.close()
+        (bound,) = row
+
+        await db.execute(
+            "UPDATE chat_versions SET log_floor = old.max_seq "
+            "FROM (SELECT chat_id, MAX(seq) AS max_seq FROM change_log WHERE seq < ? GROUP BY chat_id) AS old "
+            "WHERE chat_versions.chat_id = old.chat_id",
+            (bound,),
+        )
+        cur = await db.execute("DELETE FROM change_log WHERE seq < ?", (bound,))
+        deleted = cur.rowcount
+        await cur.close()
+        await db.commit()
+    return deleted
+
+
+async def change_log_compactor(
+    retention: int = CHANGE_LOG_RETENTION_SECONDS,
+    interval: float = CHANGE_LOG_COMPACT_SECONDS,
+):
+    while True:
+        try:
+            deleted = await compact_change_log(retention)
+            if deleted:
+                logging.info("change log compacted: deleted=%s", deleted)
+        except Exception:
+            logging.exception("change log compaction failed")
+        await asyncio.sleep(interval)
+
+
+class ChangeBus:
+    """
+    Шина изменений событий внутри процесса: кто записал событие, публикует ChatChange сразу после commit,
+    подписчики (кэши API) сбрасывают свои данные по чату. Другие процессы шину не слышат —
+    для них остаётся проверка версии чата из chat_versions.
+    """
+
+    def __init__(self):
+        self._subscribers: list[Callable[[ChatChange], None]] = []
+        self.published = 0
+
+    def subscribe(self, callback: Callable[[ChatChange], None]) -> Callable[[ChatChange], None]:
+        self._subscribers.append(callback)
+        return callback
+
+    def publish(self, change: ChatChange):
+        self.published += 1
+        for callback in list(self._subscribers):
+            try:
+                callback(change)
+            except Exception:
+                logging.exception("change bus subscriber failed: %s", change)
+
+    def stats(self) -> dict:
+        return {"subscribers": len(self._subscribers), "published": self.published}
+
+
+change_bus = ChangeBus()
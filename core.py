@@ -1,6 +1,7 @@
 import os
 import hashlib
 import hmac
+import time
 from datetime import datetime, timedelta
 from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 from zoneinfo import ZoneInfo
@@ -13,21 +14,94 @@ load_dotenv(os.path.join(BASE_DIR, ".env"))
 
 TZ = ZoneInfo("Europe/Moscow")
 DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "calendar_bot.sqlite3"))
+DB_POOL_READERS = int(os.getenv("DB_POOL_READERS", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("Set BOT_TOKEN env var")
+# Дополнительные токены, подписи которых ещё принимаем: старый токен при ротации, другие боты на той же БД
+EXTRA_BOT_TOKENS = [t.strip() for t in os.getenv("EXTRA_BOT_TOKENS", "").split(",") if t.strip()]
 
 BOT_USERNAME = os.getenv("BOT_USERNAME", "")
 WEBAPP_URL = os.getenv("WEBAPP_URL", "https://bot01.ficsh.ru/event-form")
 MINIAPP_LINK = os.getenv("MINIAPP_LINK", "")
 API_BASE_URL = os.getenv("API_BASE_URL", "")
+# Получение апдейтов: polling (по умолчанию) или webhook на том же FastAPI-приложении (только run.py)
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "") or API_BASE_URL
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# secret_token для setWebhook: A-Z, a-z, 0-9, _ и -; по умолчанию выводится из токена
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode("utf-8")).hexdigest()
+# Токен для /api/metrics (заголовок X-Metrics-Token); по умолчанию выводится из токена бота
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "") or hashlib.sha256(f"metrics:{BOT_TOKEN}".encode("utf-8")).hexdigest()
+# Свой Bot API сервер (локальный telegram-bot-api или фейковый для тестов), например http://127.0.0.1:8081
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "")
+REMINDER_CONCURRENCY = int(os.getenv("REMINDER_CONCURRENCY", "16"))
+VOTE_FLUSH_MS = int(os.getenv("VOTE_FLUSH_MS", "200"))
+VOTE_FLUSH_MAX = int(os.getenv("VOTE_FLUSH_MAX", "500"))
+# Сколько часов после начала встречи ещё принимаем голоса в её опросе
+POLL_ANSWER_GRACE_HOURS = int(os.getenv("POLL_ANSWER_GRACE_HOURS", "48"))
+# Максимальный возраст initData Mini App (auth_date), 0 — не проверять
+INITDATA_MAX_AGE = int(os.getenv("INITDATA_MAX_AGE", "86400"))
+INITDATA_CACHE_SIZE = int(os.getenv("INITDATA_CACHE_SIZE", "10000"))
+INITDATA_CACHE_TTL = float(os.getenv("INITDATA_CACHE_TTL", "3600"))
+# Подписка на календарь чата: сколько отрендеренных лент держим в памяти и сколько событий в ленте
+FEED_CACHE_SIZE = int(os.getenv("FEED_CACHE_SIZE", "1000"))
+FEED_MAX_EVENTS = int(os.getenv("FEED_MAX_EVENTS", "500"))
+# Списки предстоящих событий по чатам для /api/calendar/upcoming
+UPCOMING_CACHE_SIZE = int(os.getenv("UPCOMING_CACHE_SIZE", "1000"))
+# file_id загруженных .ics (по одному на событие)
+ICS_FILE_CACHE_SIZE = int(os.getenv("ICS_FILE_CACHE_SIZE", "5000"))
+# Права бота в чатах (можно ли закреплять); обновляются и по my_chat_member
+CHAT_MEMBER_CACHE_SIZE = int(os.getenv("CHAT_MEMBER_CACHE_SIZE", "10000"))
+CHAT_MEMBER_CACHE_TTL = float(os.getenv("CHAT_MEMBER_CACHE_TTL", "600"))
+# Очередь побочных эффектов (outbox): попытки и пауза между ними (base * 2^n, не больше max), секунды
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "2"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+# Роль scheduler держит аренду в БД: секунды до истечения (0 — без аренды, несколько реплик
+# делят работу через claims) и период перечитывания напоминаний из БД
+SCHEDULER_LEASE_TTL = int(os.getenv("SCHEDULER_LEASE_TTL", "30"))
+# Сколько секунд взятое воркером напоминание/действие outbox недоступно другим (потом claim истекает)
+CLAIM_TTL_SECONDS = int(os.getenv("CLAIM_TTL_SECONDS", "300"))
+REMINDER_RESYNC_SECONDS = float(os.getenv("REMINDER_RESYNC_SECONDS", "30"))
+# Журнал изменений для дельта-синхронизации календаря: сколько хранить записи и как часто чистить, секунды
+CHANGE_LOG_RETENTION_SECONDS = int(os.getenv("CHANGE_LOG_RETENTION_SECONDS", str(7 * 24 * 3600)))
+CHANGE_LOG_COMPACT_SECONDS = float(os.getenv("CHANGE_LOG_COMPACT_SECONDS", "3600"))
+# SSE-поток изменений (/api/calendar/stream): очередь на клиента (сообщений), пинг и опрос журнала
+# (секунды; изменения из этого же процесса приходят сразу), предел одновременных подключений
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "64"))
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+STREAM_POLL_SECONDS = float(os.getenv("STREAM_POLL_SECONDS", "2"))
+STREAM_MAX_CONNECTIONS = int(os.getenv("STREAM_MAX_CONNECTIONS", "10000"))
+# Сколько секунд действует токен подключения к потоку (выдаёт /api/calendar/changes)
+STREAM_TOKEN_TTL = int(os.getenv("STREAM_TOKEN_TTL", "600"))
+
+# Лимиты исходящих запросов к Telegram
+TG_GLOBAL_PER_SECOND = float(os.getenv("TG_GLOBAL_PER_SECOND", "30"))
+TG_GROUP_PER_MINUTE = float(os.getenv("TG_GROUP_PER_MINUTE", "20"))
+TG_GROUP_BURST = float(os.getenv("TG_GROUP_BURST", "5"))
+TG_PRIVATE_PER_SECOND = float(os.getenv("TG_PRIVATE_PER_SECOND", "1"))
+TG_RETRY_AFTER_ATTEMPTS = int(os.getenv("TG_RETRY_AFTER_ATTEMPTS", "5"))
+
+# Варианты ответа в опросе события (option_id)
+OPT_YES, OPT_MAYBE, OPT_NO = 0, 1, 2
 
 
 def now_tz() -> datetime:
     return datetime.now(tz=TZ)
 
 
+def to_epoch(dt: datetime) -> int:
+    return int(dt.timestamp())
+
+
+def now_epoch() -> int:
+    return int(time.time())
+
+
 def format_dt(dt: datetime) -> str:
     return dt.strftime("%d-%m-%Y %H:%M")
 
@@ -44,17 +118,111 @@ def format_card(dt: datetime, title: str, cost: str, location: str, details: str
     return text
 
 
+class Signer:
+    """
+    Подписи ссылок (chat_sig / user_sig) и проверка hash из initData Mini App.
+    Ключи выводятся из токена один раз, HMAC-состояние с ключом переиспользуется через copy().
+    Подписываем первым токеном, принимаем подпись любого из активных.
+    """
+
+    def __init__(self, tokens: list[str]):
+        if not tokens:
+            raise ValueError("at least one token is required")
+        self._link_macs = []
+        self._webapp_macs = []
+        for token in tokens:
+            raw = token.encode("utf-8")
+            link_key = hashlib.sha256(raw).digest()
+            webapp_key = hmac.new(b"WebAppData", raw, hashlib.sha256).digest()
+            self._link_macs.append(hmac.new(link_key, digestmod=hashlib.sha256))
+            self._webapp_macs.append(hmac.new(webapp_key, digestmod=hashlib.sha256))
+
+    @staticmethod
+    def _hexdigest(mac, msg: bytes) -> str:
+        mac = mac.copy()
+        mac.update(msg)
+        return mac.hexdigest()
+
+    @staticmethod
+    def _chat_msg(chat_id: int) -> bytes:
+        return str(chat_id).encode("utf-8")
+
+    @staticmethod
+    def _user_msg(chat_id: int, user_id: int) -> bytes:
+        return f"{chat_id}:{user_id}".encode("utf-8")
+
+    @staticmethod
+    def _user_feed_msg(user_id: int) -> bytes:
+        # отдельный префикс: подпись ленты не должна совпадать ни с одной chat_sig/user_sig
+        return f"feed:{user_id}".encode("utf-8")
+
+    @staticmethod
+    def _stream_msg(chat_id: int, user_id: int, expires_at: int) -> bytes:
+        return f"stream:{chat_id}:{user_id}:{expires_at}".encode("utf-8")
+
+    def chat_sig(self, chat_id: int) -> str:
+        return self._hexdigest(self._link_macs[0], self._chat_msg(chat_id))[:20]
+
+    def user_sig(self, chat_id: int, user_id: int) -> str:
+        return self._hexdigest(self._link_macs[0], self._user_msg(chat_id, user_id))
+
+    def user_feed_sig(self, user_id: int) -> str:
+        return self._hexdigest(self._link_macs[0], self._user_feed_msg(user_id))
+
+    def stream_token(self, chat_id: int, user_id: int, expires_at: int) -> str:
+        sig = self._hexdigest(self._link_macs[0], self._stream_msg(chat_id, user_id, expires_at))
+        return f"{user_id}.{expires_at}.{sig}"
+
+    def verify_stream_token(self, chat_id: int, token: Optional[str], now: int) -> Optional[int]:
+        """user_id из действующего токена потока; None — токен неверный или истёк."""
+        try:
+            user_id, expires_at, sig = token.split(".")
+            user_id, expires_at = int(user_id), int(expires_at)
+        except (AttributeError, ValueError):
+            return None
+        if expires_at < now:
+            return None
+        msg = self._stream_msg(chat_id, user_id, expires_at)
+        if any(hmac.compare_digest(self._hexdigest(mac, msg), sig) for mac in self._link_macs):
+            return user_id
+        return None
+
+    def verify_chat_sig(self, chat_id: int, sig: Optional[str]) -> bool:
+        if not sig:
+            return False
+        msg = self._chat_msg(chat_id)
+        return any(hmac.compare_digest(self._hexdigest(mac, msg)[:20], sig) for mac in self._link_macs)
+
+    def verify_user_sig(self, chat_id: int, user_id: int, sig: Optional[str]) -> bool:
+        if not sig:
+            return False
+        msg = self._user_msg(chat_id, user_id)
+        return any(hmac.compare_digest(self._hexdigest(mac, msg), sig) for mac in self._link_macs)
+
+    def verify_user_feed_sig(self, user_id: int, sig: Optional[str]) -> bool:
+        if not sig:
+            return False
+        msg = self._user_feed_msg(user_id)
+        return any(hmac.compare_digest(self._hexdigest(mac, msg), sig) for mac in self._link_macs)
+
+    def verify_webapp_hash(self, data_check_string: str, received_hash: str) -> bool:
+        msg = data_check_string.encode("utf-8")
+        return any(hmac.compare_digest(self._hexdigest(mac, msg), received_hash) for mac in self._webapp_macs)
+
+
+signer = Signer([BOT_TOKEN, *EXTRA_BOT_TOKENS])
+
+
 def make_chat_sig(chat_id: int) -> str:
-    key = hashlib.sha256(BOT_TOKEN.encode("utf-8")).digest()
-    msg = str(chat_id).encode("utf-8")
-    full = hmac.new(key, msg, hashlib.sha256).hexdigest()
-    return full[:20]
+    return signer.chat_sig(chat_id)
 
 
 def make_user_sig(chat_id: int, user_id: int) -> str:
-    key = hashlib.sha256(BOT_TOKEN.encode("utf-8")).digest()
-    msg = f"{chat_id}:{user_id}".encode("utf-8")
-    return hmac.new(key, msg, hashlib.sha256).hexdigest()
+    return signer.user_sig(chat_id, user_id)
+
+
+def make_user_feed_sig(user_id: int) -> str:
+    return signer.user_feed_sig(user_id)
 
 
 def with_qs(url: str, params: dict) -> str:
@@ -81,34 +249,96 @@ def build_poll_link(chat_id: int, poll_message_id: int) -> Optional[str]:
     return None
 
 
-def make_ics(dt: datetime, title: str, location: str, description: str) -> str:
-    dt_utc = dt.astimezone(ZoneInfo("UTC"))
-    dtend_utc = (dt + timedelta(hours=2)).astimezone(ZoneInfo("UTC"))
+def webcal_url(url: str) -> str:
+    if url.startswith("https://"):
+        return "webcal://" + url[len("https://"):]
+    if url.startswith("http://"):
+        return "webcal://" + url[len("http://"):]
+    return ""
+
+
+def chat_feed_url(chat_id: int) -> str:
+    api_base = api_base_url()
+    if not api_base:
+        return ""
+    return f"{api_base}/api/calendar/feed.ics?chat_id={chat_id}&sig={make_chat_sig(chat_id)}"
+
+
+def user_feed_url(user_id: int) -> str:
+    api_base = api_base_url()
+    if not api_base:
+        return ""
+    return f"{api_base}/api/calendar/my.ics?user_id={user_id}&sig={make_user_feed_sig(user_id)}"
+
+
+def event_description(cost: str, details: str) -> str:
+    description = f"Стоимость: {cost}"
+    if (details or "").strip():
+        description += f"\n\n{details.strip()}"
+    return description
+
 
-    uid = hashlib.sha1(f"{dt.isoformat()}|{title}|{location}".encode("utf-8")).hexdigest() + "@telegram-meeting-bot"
+def _ics_fmt(d: datetime) -> str:
+    return d.astimezone(ZoneInfo("UTC")).strftime("%Y%m%dT%H%M%SZ")
 
-    def fmt(d: datetime) -> str:
-        return d.strftime("%Y%m%dT%H%M%SZ")
 
-    def esc(s: str) -> str:
-        s = s or ""
-        return s.replace("\\", "\\\\").replace("\n", "\\n").replace(",", "\\,").replace(";", "\\;")
+def _ics_esc(s: str) -> str:
+    s = s or ""
+    return s.replace("\\", "\\\\").replace("\n", "\\n").replace(",", "\\,").replace(";", "\\;")
 
+
+def make_ics_vevent(
+    dt: datetime,
+    title: str,
+    location: str,
+    description: str,
+    uid: Optional[str] = None,
+    dtstamp: Optional[datetime] = None,
+    status: Optional[str] = None,
+    sequence: Optional[int] = None,
+) -> list[str]:
+    if uid is None:
+        uid = hashlib.sha1(f"{dt.isoformat()}|{title}|{location}".encode("utf-8")).hexdigest() + "@telegram-meeting-bot"
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{uid}",
+        f"DTSTAMP:{_ics_fmt(dtstamp or datetime.now(tz=ZoneInfo('UTC')))}",
+        f"DTSTART:{_ics_fmt(dt)}",
+        f"DTEND:{_ics_fmt(dt + timedelta(hours=2))}",
+        f"SUMMARY:{_ics_esc(title)}",
+        f"LOCATION:{_ics_esc(location)}",
+        f"DESCRIPTION:{_ics_esc(description)}",
+    ]
+    if sequence is not None:
+        # календарь заменяет ранее загруженное событие, только если SEQUENCE/DTSTAMP выросли
+        lines.append(f"SEQUENCE:{sequence}")
+        lines.append(f"LAST-MODIFIED:{_ics_fmt(dtstamp or datetime.now(tz=ZoneInfo('UTC')))}")
+    if status:
+        lines.append(f"STATUS:{status}")
+    lines.append("END:VEVENT")
+    return lines
+
+
+def make_ics_calendar(vevents: list[list[str]], name: Optional[str] = None) -> str:
     lines = [
         "BEGIN:VCALENDAR",
         "VERSION:2.0",
         "METHOD:PUBLISH",
         "PRODID:-//YourApp//EN",
         "CALSCALE:GREGORIAN",
-        "BEGIN:VEVENT",
-        f"UID:{uid}",
-        f"DTSTAMP:{fmt(datetime.now(tz=ZoneInfo('UTC')))}",
-        f"DTSTART:{fmt(dt_utc)}",
-        f"DTEND:{fmt(dtend_utc)}",
-        f"SUMMARY:{esc(title)}",
-        f"LOCATION:{esc(location)}",
-        f"DESCRIPTION:{esc(description)}",
-        "END:VEVENT",
-        "END:VCALENDAR",
     ]
+    if name:
+        # подписка: имя календаря и желаемая частота обновления
+        lines += [
+            f"X-WR-CALNAME:{_ics_esc(name)}",
+            "REFRESH-INTERVAL;VALUE=DURATION:PT1H",
+            "X-PUBLISHED-TTL:PT1H",
+        ]
+    for vevent in vevents:
+        lines += vevent
+    lines.append("END:VCALENDAR")
     return "\r\n".join(lines) + "\r\n"
+
+
+def make_ics(dt: datetime, title: str, location: str, description: str) -> str:
+    return make_ics_calendar([make_ics_vevent(dt, title, location, description)])
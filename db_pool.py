@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import aiosqlite
+
+from core import DB_PATH, DB_POOL_READERS, DB_BUSY_TIMEOUT_MS
+from db_schema import CREATE_SQL, MIGRATIONS
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class DBPool:
+    """
+    Общий на процесс пул долгоживущих aiosqlite-соединений:
+    один писатель (сериализуется локом) и N читателей (WAL позволяет читать параллельно).
+    PRAGMA применяются один раз при открытии соединения.
+    """
+
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.readers = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock = asyncio.Lock()
+        self._idle_readers: Optional[asyncio.Queue] = None
+        self._open_lock = asyncio.Lock()
+
+        self.acquired = {"reader": 0, "writer": 0}
+        self.waited = {"reader": 0, "writer": 0}
+        self.wait_seconds_total = {"reader": 0.0, "writer": 0.0}
+        self.wait_seconds_max = {"reader": 0.0, "writer": 0.0}
+        self.waiting = {"reader": 0, "writer": 0}
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self, readonly: bool) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        if readonly:
+            await conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self.is_open:
+                return
+            writer = await self._connect(readonly=False)
+            idle = asyncio.Queue()
+            for _ in range(self.readers):
+                idle.put_nowait(await self._connect(readonly=True))
+            self._idle_readers = idle
+            self._writer = writer
+            logging.info("db pool opened: path=%s readers=%s", self.path, self.readers)
+
+    async def close(self):
+        async with self._open_lock:
+            if not self.is_open:
+                return
+            async with self._writer_lock:
+                await self._writer.close()
+                self._writer = None
+            while not self._idle_readers.empty():
+                await self._idle_readers.get_nowait().close()
+            self._idle_readers = None
+            logging.info("db pool closed")
+
+    async def acquire(self, write: bool = False) -> aiosqlite.Connection:
+        if not self.is_open:
+            await self.open()
+
+        role = "writer" if write else "reader"
+        started = time.monotonic()
+        self.waiting[role] += 1
+        try:
+            if write:
+                await self._writer_lock.acquire()
+                conn = self._writer
+            else:
+                conn = await self._idle_readers.get()
+        finally:
+            self.waiting[role] -= 1
+
+        waited = time.monotonic() - started
+        self.acquired[role] += 1
+        if waited > 0.001:
+            self.waited[role] += 1
+        self.wait_seconds_total[role] += waited
+        self.wait_seconds_max[role] = max(self.wait_seconds_max[role], waited)
+        return conn
+
+    async def release(self, conn: aiosqlite.Connection):
+        try:
+            if conn.in_transaction:
+                # транзакцию бросили без commit (исключение в обработчике) — не отдаём её следующему
+                await conn.rollback()
+        except Exception:
+            logging.exception("db pool: rollback on release failed")
+
+        if conn is self._writer:
+            self._writer_lock.release()
+        elif self._idle_readers is not None:
+            self._idle_readers.put_nowait(conn)
+        else:
+            await conn.close()
+
+    @asynccontextmanager
+    async def connection(self, write: bool = False):
+        conn = await self.acquire(write=write)
+        try:
+            yield conn
+        finally:
+            await self.release(conn)
+
+    def stats(self) -> dict:
+        return {
+            "readers": self.readers,
+            "readers_idle": self._idle_readers.qsize() if self._idle_readers is not None else 0,
+            "writer_busy": self._writer_lock.locked(),
+            "acquired": dict(self.acquired),
+            "waited": dict(self.waited),
+            "waiting": dict(self.waiting),
+            "wait_ms_total": {k: round(v * 1000, 3) for k, v in self.wait_seconds_total.items()},
+            "wait_ms_max": {k: round(v * 1000, 3) for k, v in self.wait_seconds_max.items()},
+        }
+
+
+pool = DBPool(DB_PATH, DB_POOL_READERS)
+
+
+async def apply_migrations(db):
+    for version, statements in enumerate(MIGRATIONS, start=1):
+        # BEGIN IMMEDIATE + повторная проверка версии: другой процесс мог успеть мигрировать
+        await db.execute("BEGIN IMMEDIATE")
+        cur = await db.execute("PRAGMA user_version")
+        (current,) = await cur.fetchone()
+        await cur.close()
+        if current >= version:
+            await db.rollback()
+            continue
+        for sql in statements:
+            await db.execute(sql)
+        await db.execute(f"PRAGMA user_version={version}")
+        await db.commit()
+        logging.info("db migration %s applied", version)
+
+
+async def init_db():
+    async with pool.connection(write=True) as db:
+        await db.executescript(CREATE_SQL)
+        await db.commit()
+        await apply_migrations(db)
+
+
+async def close_db():
+    await pool.close()
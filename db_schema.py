@@ -43,7 +43,89 @@ CREATE TABLE IF NOT EXISTS users (
   updated_at_iso TEXT NOT NULL
 );
 
-CREATE INDEX IF NOT EXISTS idx_events_chat_dt ON events(chat_id, dt_iso);
-CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders(sent, run_at_iso);
 CREATE INDEX IF NOT EXISTS idx_votes_poll_user ON votes(poll_id, user_id);
 """
+
+# Миграции поверх CREATE_SQL. Номер последней применённой хранится в PRAGMA user_version,
+# каждая миграция выполняется в одной транзакции.
+MIGRATIONS = [
+    # 1: время события и напоминания в UTC epoch (dt_iso/run_at_iso могут быть с любым смещением)
+    (
+        "ALTER TABLE events ADD COLUMN dt_utc_epoch INTEGER",
+        "UPDATE events SET dt_utc_epoch = CAST(strftime('%s', dt_iso) AS INTEGER) WHERE dt_utc_epoch IS NULL",
+        "ALTER TABLE reminders ADD COLUMN run_at_epoch INTEGER",
+        "UPDATE reminders SET run_at_epoch = CAST(strftime('%s', run_at_iso) AS INTEGER) WHERE run_at_epoch IS NULL",
+        "DROP INDEX IF EXISTS idx_events_chat_dt",
+        "DROP INDEX IF EXISTS idx_reminders_due",
+        "CREATE INDEX IF NOT EXISTS idx_events_chat_epoch ON events(chat_id, dt_utc_epoch)",
+        "CREATE INDEX IF NOT EXISTS idx_reminders_due_epoch ON reminders(sent, run_at_epoch)",
+    ),
+    # 2: счётчик изменений событий по чату (ETag/Last-Modified для подписки на календарь)
+    (
+        """CREATE TABLE IF NOT EXISTS chat_versions (
+          chat_id INTEGER PRIMARY KEY,
+          version INTEGER NOT NULL,
+          updated_at_epoch INTEGER NOT NULL
+        )""",
+        "INSERT OR IGNORE INTO chat_versions(chat_id, version, updated_at_epoch) "
+        "SELECT chat_id, 1, CAST(strftime('%s', 'now') AS INTEGER) FROM events GROUP BY chat_id",
+    ),
+    # 3: голоса пользователя по всем чатам (личная лента календаря)
+    (
+        "CREATE INDEX IF NOT EXISTS idx_votes_user ON votes(user_id, option_id, poll_id)",
+    ),
+    # 4: outbox — побочные эффекты в Telegram, выполняемые воркером с повторами
+    (
+        """CREATE TABLE IF NOT EXISTS outbox (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          kind TEXT NOT NULL,
+          payload TEXT NOT NULL,
+          dedup_key TEXT UNIQUE,
+          attempts INTEGER NOT NULL DEFAULT 0,
+          generation INTEGER NOT NULL DEFAULT 0,
+          next_attempt_epoch INTEGER NOT NULL,
+          failed INTEGER NOT NULL DEFAULT 0,
+          last_error TEXT,
+          created_at_epoch INTEGER NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(failed, next_attempt_epoch)",
+    ),
+    # 5: аренды (единственный экземпляр планировщика среди нескольких процессов)
+    (
+        """CREATE TABLE IF NOT EXISTS leases (
+          name TEXT PRIMARY KEY,
+          holder TEXT NOT NULL,
+          expires_at_epoch INTEGER NOT NULL
+        )""",
+    ),
+    # 6: claims — какой воркер и до какого времени взял напоминание / действие outbox
+    (
+        "ALTER TABLE reminders ADD COLUMN claimed_by TEXT",
+        "ALTER TABLE reminders ADD COLUMN claimed_until INTEGER",
+        "ALTER TABLE outbox ADD COLUMN claimed_by TEXT",
+        "ALTER TABLE outbox ADD COLUMN claimed_until INTEGER",
+    ),
+    # 7: отдельный счётчик голосов чата — голоса не сбрасывают кэши событий
+    (
+        "ALTER TABLE chat_versions ADD COLUMN vote_version INTEGER NOT NULL DEFAULT 0",
+    ),
+    # 8: журнал изменений для /api/calendar/changes; log_floor — последний seq чата, вычищенный компактизацией
+    (
+        """CREATE TABLE IF NOT EXISTS change_log (
+          seq INTEGER PRIMARY KEY AUTOINCREMENT,
+          chat_id INTEGER NOT NULL,
+          event_id INTEGER NOT NULL,
+          action TEXT NOT NULL,
+          user_id INTEGER,
+          created_at_epoch INTEGER NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_change_log_chat ON change_log(chat_id, seq)",
+        "ALTER TABLE chat_versions ADD COLUMN log_floor INTEGER NOT NULL DEFAULT 0",
+    ),
+    # 9: номер правки события и время последнего изменения (SEQUENCE / DTSTAMP в подписке .ics)
+    (
+        "ALTER TABLE events ADD COLUMN revision INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE events ADD COLUMN updated_at_epoch INTEGER",
+        "UPDATE events SET updated_at_epoch = CAST(strftime('%s', created_at_iso) AS INTEGER)",
+    ),
+]
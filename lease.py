@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable
+
+from core import now_epoch
+from db_pool import pool
+
+
+def make_holder_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+# Идентификатор этого процесса: владелец аренд и claims
+WORKER_ID = make_holder_id()
+
+
+class Lease:
+    """
+    Аренда в SQLite (таблица leases): в каждый момент у имени не больше одного владельца.
+    Владелец продлевает аренду каждые ttl/3 секунд; если не смог — считает её потерянной
+    и останавливает работу. Чужая аренда переходит к другому, только когда истекла.
+    """
+
+    def __init__(self, name: str, ttl: int, holder: str = ""):
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or WORKER_ID
+        self.held = False
+        self.acquired = 0
+        self.lost = 0
+
+    async def try_acquire(self) -> bool:
+        """Захватывает или продлевает аренду. True — мы владелец до now + ttl."""
+        now = now_epoch()
+        async with pool.connection(write=True) as db:
+            cur = await db.execute(
+                "INSERT INTO leases(name, holder, expires_at_epoch) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_at_epoch=excluded.expires_at_epoch "
+                "WHERE leases.holder=excluded.holder OR leases.expires_at_epoch < ? "
+                "RETURNING holder",
+                (self.name, self.holder, now + self.ttl, now),
+            )
+            row = await cur.fetchone()
+            await cur.close()
+            await db.commit()
+        return row is not None
+
+    async def release(self):
+        async with pool.connection(write=True) as db:
+            await db.execute("DELETE FROM leases WHERE name=? AND holder=?", (self.name, self.holder))
+            await db.commit()
+        self.held = False
+
+    async def run_while_held(self, work: Callable[[], Awaitable[None]]):
+        """Ждёт аренду, запускает work() и держит аренду, пока work работает. Потеря аренды — отмена work."""
+        interval = max(1.0, self.ttl / 3)
+        while True:
+            try:
+                acquired = await self.try_acquire()
+            except Exception:
+                logging.exception("lease %s: acquire failed", self.name)
+                acquired = False
+            if not acquired:
+                await asyncio.sleep(interval)
+                continue
+
+            self.held = True
+            self.acquired += 1
+            logging.info("lease %s acquired by %s", self.name, self.holder)
+            task = asyncio.create_task(work())
+            try:
+                while True:
+                    await asyncio.wait({task}, timeout=interval)
+                    if task.done():
+                        break
+                    try:
+                        renewed = await self.try_acquire()
+                    except Exception:
+                        logging.exception("lease %s: renew failed", self.name)
+                        renewed = False
+                    if not renewed:
+                        self.lost += 1
+                        logging.warning("lease %s lost by %s, stopping", self.name, self.holder)
+                        break
+            except asyncio.CancelledError:
+                # остановка процесса: отдаём аренду сразу, не дожидаясь истечения ttl
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await self.release()
+                raise
+            finally:
+                self.held = False
+
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                continue
+            if task.cancelled():
+                continue
+            if task.exception() is not None:
+                logging.error("lease %s: work failed", self.name, exc_info=task.exception())
+                await self.release()
+                await asyncio.sleep(interval)
+                continue
+            # работа закончилась сама — отдаём аренду
+            await self.release()
+            return
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "holder": self.holder,
+            "held": self.held,
+            "acquired": self.acquired,
+            "lost": self.lost,
+        }
@@ -0,0 +1,238 @@
+import asyncio
+import bisect
+import contextvars
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from typing import Optional, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    TelegramMethod,
+    SendMessage,
+    SendPoll,
+    SendDocument,
+    PinChatMessage,
+    UnpinChatMessage,
+    EditMessageText,
+    EditMessageReplyMarkup,
+    DeleteMessage,
+)
+
+from core import (
+    TG_GLOBAL_PER_SECOND,
+    TG_GROUP_PER_MINUTE,
+    TG_GROUP_BURST,
+    TG_PRIVATE_PER_SECOND,
+    TG_RETRY_AFTER_ATTEMPTS,
+)
+
+# Чем меньше число, тем раньше уходит запрос
+PRIORITY_REMINDER = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BULK = 2
+
+THROTTLED_METHODS = (
+    SendMessage,
+    SendPoll,
+    SendDocument,
+    PinChatMessage,
+    UnpinChatMessage,
+    EditMessageText,
+    EditMessageReplyMarkup,
+    DeleteMessage,
+)
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("outbound_priority", default=PRIORITY_DEFAULT)
+
+
+@contextmanager
+def outbound_priority(priority: int):
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst and now >= self.blocked_until
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Общая очередь исходящих запросов к Telegram (подключается как request middleware сессии бота).
+    Запрос уходит, когда есть токен и в глобальном bucket, и в bucket его чата;
+    среди ожидающих первым идёт запрос с меньшим приоритетом, затем — по времени постановки.
+    На 429 чат (или всё, если чата нет) замораживается на retry_after, запрос повторяется.
+    """
+
+    def __init__(
+        self,
+        global_per_second: float,
+        group_per_minute: float,
+        group_burst: float,
+        private_per_second: float,
+        retry_after_attempts: int,
+    ):
+        self.global_bucket = TokenBucket(global_per_second, global_per_second)
+        self.group_rate = group_per_minute / 60.0
+        self.group_burst = group_burst
+        self.private_rate = private_per_second
+        self.retry_after_attempts = retry_after_attempts
+        self._chat_buckets: dict[Union[int, str], TokenBucket] = {}
+        self._waiters: list[tuple[int, int, Optional[Union[int, str]], asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._pump_task: Optional[asyncio.Task] = None
+
+        self.sent = 0
+        self.delayed = 0
+        self.retry_after_hits = 0
+        self.wait_seconds_total = 0.0
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                now = time.monotonic()
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.idle(now)}
+            # личные чаты — положительные id, группы/каналы — отрицательные или @username
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.private_rate, max(1.0, self.private_rate))
+            else:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id: Optional[Union[int, str]], priority: int):
+        fut = asyncio.get_running_loop().create_future()
+        bisect.insort(self._waiters, (priority, next(self._seq), chat_id, fut), key=lambda w: (w[0], w[1]))
+        self._wakeup.set()
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await fut
+
+    async def _pump(self):
+        while self._waiters:
+            self._wakeup.clear()
+            now = time.monotonic()
+            sleep_for = self.global_bucket.delay(now)
+            if sleep_for <= 0:
+                sleep_for = float("inf")
+                for i, (_, _, chat_id, fut) in enumerate(self._waiters):
+                    if fut.done():
+                        del self._waiters[i]
+                        sleep_for = 0
+                        break
+                    chat_delay = 0.0 if chat_id is None else self._chat_bucket(chat_id).delay(now)
+                    if chat_delay <= 0:
+                        del self._waiters[i]
+                        self.global_bucket.take(now)
+                        if chat_id is not None:
+                            self._chat_bucket(chat_id).take(now)
+                        fut.set_result(None)
+                        sleep_for = 0
+                        break
+                    sleep_for = min(sleep_for, chat_delay)
+            if sleep_for > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), sleep_for)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(0)
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ):
+        if not isinstance(method, THROTTLED_METHODS):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        priority = _priority.get()
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            await self._acquire(chat_id, priority)
+            waited = time.monotonic() - started
+            self.wait_seconds_total += waited
+            if waited > 0.001:
+                self.delayed += 1
+            try:
+                result = await make_request(bot, method)
+                self.sent += 1
+                return result
+            except TelegramRetryAfter as e:
+                self.retry_after_hits += 1
+                attempt += 1
+                logging.warning(
+                    "telegram flood control: method=%s chat_id=%s retry_after=%s attempt=%s",
+                    type(method).__name__,
+                    chat_id,
+                    e.retry_after,
+                    attempt,
+                )
+                if attempt > self.retry_after_attempts:
+                    raise
+                until = time.monotonic() + e.retry_after
+                if chat_id is None:
+                    self.global_bucket.block(until)
+                else:
+                    self._chat_bucket(chat_id).block(until)
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._waiters),
+            "sent": self.sent,
+            "delayed": self.delayed,
+            "retry_after_hits": self.retry_after_hits,
+            "wait_ms_total": round(self.wait_seconds_total * 1000, 3),
+            "chat_buckets": len(self._chat_buckets),
+        }
+
+
+outbound = OutboundScheduler(
+    global_per_second=TG_GLOBAL_PER_SECOND,
+    group_per_minute=TG_GROUP_PER_MINUTE,
+    group_burst=TG_GROUP_BURST,
+    private_per_second=TG_PRIVATE_PER_SECOND,
+    retry_after_attempts=TG_RETRY_AFTER_ATTEMPTS,
+)
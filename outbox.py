@@ -0,0 +1,220 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNotFound
+
+from core import (
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_BACKOFF_BASE,
+    OUTBOX_BACKOFF_MAX,
+    OUTBOX_CONCURRENCY,
+    CLAIM_TTL_SECONDS,
+    now_epoch,
+)
+from db_pool import pool
+from lease import WORKER_ID
+
+# Если действия ставит другой процесс (notify() до нас не дойдёт), воркер заглядывает в таблицу не реже этого
+OUTBOX_POLL_SECONDS = 5.0
+
+Handler = Callable[[Any, dict], Awaitable[None]]
+
+
+class Outbox:
+    """
+    Надёжная очередь побочных эффектов (запросов к Telegram).
+    Действие пишется в таблицу outbox в той же транзакции, что и изменение данных,
+    после commit вызывающий будит воркер через notify().
+    Воркер выполняет действие; при ошибке повторяет с экспоненциальной паузой,
+    после max_attempts (или сразу на «постоянной» ошибке) помечает failed и больше не трогает.
+    dedup_key: повторная постановка с тем же ключом заменяет ещё не выполненное действие.
+    Несколько воркеров (реплик) делят очередь через claim: UPDATE ... RETURNING берёт строки
+    атомарно, claim упавшего воркера истекает через claim_ttl.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int,
+        backoff_base: float,
+        backoff_max: float,
+        concurrency: int,
+        claim_ttl: int,
+        batch_size: int = 100,
+        permanent_errors: tuple[type[BaseException], ...] = (),
+    ):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.concurrency = concurrency
+        self.claim_ttl = claim_ttl
+        self.batch_size = batch_size
+        self.permanent_errors = permanent_errors
+        self._handlers: dict[str, Handler] = {}
+        self._wakeup = asyncio.Event()
+
+        self.executed = 0
+        self.retried = 0
+        self.failed = 0
+
+    def handler(self, kind: str) -> Callable[[Handler], Handler]:
+        def register(func: Handler) -> Handler:
+            self._handlers[kind] = func
+            return func
+        return register
+
+    async def enqueue(self, db, kind: str, payload: dict, dedup_key: Optional[str] = None, delay: int = 0):
+        """Вызывается внутри транзакции вызывающего; commit — его забота."""
+        if kind not in self._handlers:
+            raise ValueError(f"unknown outbox action: {kind}")
+        now = now_epoch()
+        await db.execute(
+            "INSERT INTO outbox(kind, payload, dedup_key, attempts, generation, next_attempt_epoch, failed, created_at_epoch) "
+            "VALUES (?, ?, ?, 0, 0, ?, 0, ?) "
+            "ON CONFLICT(dedup_key) DO UPDATE SET kind=excluded.kind, payload=excluded.payload, attempts=0, "
+            "generation=generation+1, next_attempt_epoch=excluded.next_attempt_epoch, failed=0, last_error=NULL, "
+            "claimed_by=NULL, claimed_until=NULL",
+            (kind, json.dumps(payload, ensure_ascii=False), dedup_key, now + delay, now),
+        )
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _backoff(self, attempts: int) -> int:
+        return int(min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max))
+
+    async def _execute(self, bot, row, semaphore: asyncio.Semaphore) -> Optional[tuple[str, bool]]:
+        """None — выполнено; иначе (текст ошибки, постоянная ли она)."""
+        outbox_id, kind, payload, attempts, _ = row
+        handler = self._handlers.get(kind)
+        if handler is None:
+            return f"no handler for {kind}", True
+        async with semaphore:
+            try:
+                await handler(bot, json.loads(payload))
+                return None
+            except self.permanent_errors as e:
+                logging.warning("outbox action dropped: id=%s kind=%s error=%s", outbox_id, kind, e)
+                return f"{type(e).__name__}: {e}", True
+            except Exception as e:
+                logging.warning(
+                    "outbox action failed: id=%s kind=%s attempt=%s error=%s",
+                    outbox_id,
+                    kind,
+                    attempts + 1,
+                    type(e).__name__,
+                )
+                return f"{type(e).__name__}: {e}", False
+
+    async def process_due(self, bot) -> int:
+        now = now_epoch()
+        async with pool.connection(write=True) as db:
+            cur = await db.execute(
+                "UPDATE outbox SET claimed_by=?, claimed_until=? WHERE id IN ("
+                "  SELECT id FROM outbox WHERE failed=0 AND next_attempt_epoch <= ? "
+                "  AND (claimed_until IS NULL OR claimed_until < ?) ORDER BY next_attempt_epoch, id LIMIT ?"
+                ") RETURNING id, kind, payload, attempts, generation",
+                (WORKER_ID, now + self.claim_ttl, now, now, self.batch_size),
+            )
+            rows = await cur.fetchall()
+            await cur.close()
+            await db.commit()
+        if not rows:
+            return 0
+        rows.sort(key=lambda row: row[0])
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._execute(bot, row, semaphore) for row in rows))
+
+        done, retry, failed = [], [], []
+        now = now_epoch()
+        for (outbox_id, kind, _, attempts, generation), result in zip(rows, results):
+            # generation: пока действие выполнялось, его могли поставить заново — такую строку не трогаем
+            if result is None:
+                done.append((outbox_id, generation))
+                continue
+            error, permanent = result
+            if permanent or attempts + 1 >= self.max_attempts:
+                failed.append((attempts + 1, error[:500], outbox_id, generation))
+                if not permanent:
+                    logging.error("outbox action gave up: id=%s kind=%s attempts=%s", outbox_id, kind, attempts + 1)
+            else:
+                retry.append((attempts + 1, now + self._backoff(attempts + 1), error[:500], outbox_id, generation))
+
+        async with pool.connection(write=True) as db:
+            await db.executemany("DELETE FROM outbox WHERE id=? AND generation=?", done)
+            await db.executemany(
+                "UPDATE outbox SET attempts=?, next_attempt_epoch=?, last_error=?, claimed_by=NULL, claimed_until=NULL "
+                "WHERE id=? AND generation=?",
+                retry,
+            )
+            await db.executemany(
+                "UPDATE outbox SET attempts=?, failed=1, last_error=?, claimed_by=NULL, claimed_until=NULL "
+                "WHERE id=? AND generation=?",
+                failed,
+            )
+            await db.commit()
+
+        self.executed += len(done)
+        self.retried += len(retry)
+        self.failed += len(failed)
+        return len(rows)
+
+    async def _next_attempt_at(self) -> Optional[int]:
+        async with pool.connection() as db:
+            # строки, взятые другим воркером, станут доступны не раньше истечения claim
+            cur = await db.execute(
+                "SELECT MIN(MAX(next_attempt_epoch, COALESCE(claimed_until + 1, 0))) FROM outbox WHERE failed=0"
+            )
+            (next_at,) = await cur.fetchone()
+            await cur.close()
+        return next_at
+
+    async def run(self, bot, poll_interval: Optional[float] = None):
+        """
+        poll_interval=None — просыпаемся только по notify() и к next_attempt_epoch (все enqueue в этом процессе);
+        иначе ещё и не реже раза в poll_interval. Пишущую транзакцию (claim) открываем, только если что-то созрело.
+        """
+        while True:
+            self._wakeup.clear()
+            try:
+                next_at = await self._next_attempt_at()
+                if next_at is not None and next_at <= now_epoch():
+                    if await self.process_due(bot) >= self.batch_size:
+                        continue
+                    next_at = await self._next_attempt_at()
+            except Exception:
+                logging.exception("outbox worker: processing failed")
+                next_at = None
+
+            timeout = poll_interval
+            if next_at is not None:
+                delay = max(0.0, next_at - time.time())
+                timeout = delay if timeout is None else min(timeout, delay)
+            if timeout is None and next_at is None:
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "executed": self.executed,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+outbox = Outbox(
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    backoff_base=OUTBOX_BACKOFF_BASE,
+    backoff_max=OUTBOX_BACKOFF_MAX,
+    concurrency=OUTBOX_CONCURRENCY,
+    claim_ttl=CLAIM_TTL_SECONDS,
+    # Telegram не примет такой запрос и при повторе: сообщение удалено, бота выгнали и т.п.
+    permanent_errors=(TelegramBadRequest, TelegramForbiddenError, TelegramNotFound),
+)
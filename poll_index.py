@@ -0,0 +1,71 @@
+import logging
+from typing import Optional
+
+from core import POLL_ANSWER_GRACE_HOURS, now_epoch
+
+# Как часто выкидывать из индекса опросы прошедших встреч
+PRUNE_INTERVAL_SECONDS = 3600
+
+
+class PollIndex:
+    """
+    Опросы ещё не прошедших встреч, созданные ботом: poll_id -> до какого момента (epoch) принимать ответы.
+    Позволяет отбросить ответ на чужой или давно закрытый опрос, не трогая SQLite.
+    Ответы принимаются до начала встречи плюс grace; прошедшие опросы вычищаются раз в PRUNE_INTERVAL_SECONDS.
+    Пока индекс не загружен, пропускаем всё (запись всё равно проверит EXISTS по events).
+    """
+
+    def __init__(self, grace_seconds: int):
+        self.grace_seconds = grace_seconds
+        self._polls: dict[str, int] = {}
+        self._next_prune = 0
+        self.loaded = False
+        self.rejected = 0
+
+    async def load(self, db):
+        now = now_epoch()
+        cur = await db.execute(
+            "SELECT poll_id, dt_utc_epoch FROM events WHERE poll_id IS NOT NULL AND dt_utc_epoch >= ?",
+            (now - self.grace_seconds,),
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+        self._polls = {poll_id: int(dt_epoch) + self.grace_seconds for poll_id, dt_epoch in rows}
+        self._next_prune = now + PRUNE_INTERVAL_SECONDS
+        self.loaded = True
+        logging.info("poll index loaded: polls=%s", len(self._polls))
+
+    def add(self, poll_id: str, dt_epoch: int):
+        """Новый опрос или перенос встречи на другое время."""
+        self._polls[poll_id] = dt_epoch + self.grace_seconds
+
+    def discard(self, poll_id: Optional[str]):
+        if poll_id:
+            self._polls.pop(poll_id, None)
+
+    def _prune(self, now: int):
+        if now < self._next_prune:
+            return
+        self._polls = {poll_id: until for poll_id, until in self._polls.items() if until >= now}
+        self._next_prune = now + PRUNE_INTERVAL_SECONDS
+
+    def accepts(self, poll_id: str) -> bool:
+        if not self.loaded:
+            return True
+        now = now_epoch()
+        self._prune(now)
+        until = self._polls.get(poll_id)
+        if until is not None and until >= now:
+            return True
+        self.rejected += 1
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self.loaded,
+            "polls": len(self._polls),
+            "rejected": self.rejected,
+        }
+
+
+poll_index = PollIndex(POLL_ANSWER_GRACE_HOURS * 3600)
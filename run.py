@@ -1,39 +1,131 @@
+import argparse
 import asyncio
 import os
 import logging
 import uvicorn
-from aiogram import Bot, Dispatcher
-from aiogram.enums import ParseMode
-from aiogram.client.default import DefaultBotProperties
+from aiogram import Dispatcher
+from fastapi import FastAPI
 
-from bot import router, init_db, reminders_worker
+from bot import router, reminders_worker, outbox_worker, create_bot, init_bot_state
+from core import BOT_MODE, SCHEDULER_LEASE_TTL, REMINDER_RESYNC_SECONDS
+from db_pool import init_db, close_db
+from changes import change_log_compactor
+from lease import Lease
+from outbox import OUTBOX_POLL_SECONDS
+from vote_buffer import vote_buffer
 from server import app as fastapi_app
-from core import BOT_TOKEN
+from webhook import WebhookReceiver
 
 logging.basicConfig(level=logging.INFO, force=True)
 
+# api — HTTP API и Mini App (можно несколько воркеров uvicorn);
+# bot — приём апдейтов (polling или webhook);
+# scheduler — напоминания и outbox; по умолчанию активен один экземпляр (аренда в БД),
+#             с SCHEDULER_LEASE_TTL=0 работают все, каждое напоминание берётся атомарным claim.
+ROLES = ("api", "bot", "scheduler")
 
-async def main():
-    await init_db()
 
-    bot = Bot(
-        token=BOT_TOKEN,
-        default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN),
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Quiz calendar bot")
+    parser.add_argument(
+        "--roles",
+        default=os.environ.get("RUN_ROLES", ",".join(ROLES)),
+        help="comma-separated roles: api,bot,scheduler (default: all)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("API_WORKERS", 1)),
+        help="uvicorn workers, only when the process runs the api role alone",
     )
-    dp = Dispatcher()
-    dp.include_router(router)
+    args = parser.parse_args()
+    args.roles = {r.strip() for r in args.roles.split(",") if r.strip()}
+    unknown = args.roles - set(ROLES)
+    if unknown or not args.roles:
+        parser.error(f"unknown roles: {', '.join(sorted(unknown)) or '(empty)'}")
+    return args
+
+
+async def main(roles: set[str]):
+    await init_db()
 
     port = int(os.environ.get("PORT", 6000))
-    config = uvicorn.Config(fastapi_app, host="0.0.0.0", port=port, log_level="info")
-    server = uvicorn.Server(config)
-
-    logging.info("Starting bot + server on port %d", port)
-    await asyncio.gather(
-        server.serve(),
-        dp.start_polling(bot),
-        reminders_worker(bot),
-    )
+    tasks = []
+    receiver = None
+    bot = create_bot() if roles & {"bot", "scheduler"} else None
+
+    if "api" in roles:
+        config = uvicorn.Config(fastapi_app, host="0.0.0.0", port=port, log_level="info")
+        tasks.append(uvicorn.Server(config).serve())
+
+    if "bot" in roles:
+        await init_bot_state(bot)
+        dp = Dispatcher()
+        dp.include_router(router)
+        if BOT_MODE == "webhook":
+            # апдейты приходят POST'ом на uvicorn, цикла getUpdates нет;
+            # без роли api поднимаем отдельное маленькое приложение только под webhook
+            webhook_app = fastapi_app if "api" in roles else FastAPI()
+            receiver = WebhookReceiver(dp, bot)
+            receiver.mount(webhook_app)
+            webhook_app.state.webhook = receiver
+            if "api" not in roles:
+                webhook_port = int(os.environ.get("WEBHOOK_PORT", 6001))
+                config = uvicorn.Config(webhook_app, host="0.0.0.0", port=webhook_port, log_level="info")
+                tasks.append(uvicorn.Server(config).serve())
+            await receiver.register()
+        else:
+            await bot.delete_webhook()
+            tasks.append(dp.start_polling(bot))
+
+    if "scheduler" in roles:
+        # Напоминания и действия outbox создают обработчики бота. Без чтения БД можно обойтись, только если
+        # каждый процесс сам исполняет всё, что пишет: все роли и планировщик без аренды. Иначе бот
+        # другой реплики (или отдельного процесса) пишет в БД, а цикл крутится здесь — перечитываем/опрашиваем.
+        self_contained = roles == set(ROLES) and SCHEDULER_LEASE_TTL <= 0
+        reminder_resync = None if self_contained else REMINDER_RESYNC_SECONDS
+        outbox_poll = None if self_contained else OUTBOX_POLL_SECONDS
+
+        async def scheduler_work():
+            await asyncio.gather(
+                reminders_worker(bot, reminder_resync),
+                outbox_worker(bot, outbox_poll),
+                change_log_compactor(),
+            )
+
+        if SCHEDULER_LEASE_TTL > 0:
+            # один активный планировщик, остальные реплики ждут аренду
+            lease = Lease("scheduler", SCHEDULER_LEASE_TTL)
+            fastapi_app.state.scheduler_lease = lease
+            tasks.append(lease.run_while_held(scheduler_work))
+        else:
+            # все реплики работают одновременно, напоминания и outbox делятся через claims
+            tasks.append(scheduler_work())
+
+    logging.info("Starting roles=%s bot_mode=%s port=%d", ",".join(sorted(roles)), BOT_MODE, port)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if receiver is not None:
+            await receiver.close()
+        await vote_buffer.close()
+        if bot is not None:
+            await bot.session.close()
+        await close_db()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    if args.roles == {"api"} and args.workers > 1:
+        # несколько процессов uvicorn; БД и миграции каждый открывает сам (startup в server.py)
+        uvicorn.run(
+            "server:app",
+            host="0.0.0.0",
+            port=int(os.environ.get("PORT", 6000)),
+            workers=args.workers,
+            log_level="info",
+        )
+    else:
+        if args.workers > 1:
+            logging.warning("--workers is ignored unless the process runs only the api role")
+        asyncio.run(main(args.roles))
@@ -0,0 +1,168 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+from db_pool import pool
+
+REMINDER_RETRY_SECONDS = 30
+
+
+class ReminderScheduler:
+    """
+    Таймер-куча неотправленных напоминаний.
+    БД остаётся источником истины: куча только говорит, когда проснуться,
+    а что именно отправлять — решает запрос due-напоминаний в момент пробуждения.
+    Отменённые/перепланированные записи удаляются из кучи лениво.
+    Кучу ведёт только процесс, где крутится цикл (active: от load() до stop());
+    в остальных напоминания попадают в БД, а сюда — при resync владельца цикла.
+    """
+
+    def __init__(self, retry_delay: float = REMINDER_RETRY_SECONDS):
+        self.retry_delay = retry_delay
+        self._heap: list[tuple[int, int]] = []  # (run_at_epoch, reminder_id)
+        self._entries: dict[int, tuple[int, int]] = {}  # reminder_id -> (run_at_epoch, event_id)
+        self._by_event: dict[int, set[int]] = {}
+        self._wakeup = asyncio.Event()
+        self.active = False
+        self.fired = 0
+        self.resyncs = 0
+
+    def schedule(self, reminder_id: int, event_id: int, run_at_epoch: int):
+        self._discard(reminder_id)
+        self._entries[reminder_id] = (run_at_epoch, event_id)
+        self._by_event.setdefault(event_id, set()).add(reminder_id)
+        heapq.heappush(self._heap, (run_at_epoch, reminder_id))
+        if self._heap[0] == (run_at_epoch, reminder_id):
+            # новое ближайшее напоминание — будим цикл, чтобы он пересчитал сон
+            self._wakeup.set()
+        self._compact()
+
+    def cancel_event(self, event_id: int):
+        for reminder_id in self._by_event.pop(event_id, ()):
+            self._entries.pop(reminder_id, None)
+        self._compact()
+
+    def _discard(self, reminder_id: int):
+        entry = self._entries.pop(reminder_id, None)
+        if entry is not None:
+            ids = self._by_event.get(entry[1])
+            if ids is not None:
+                ids.discard(reminder_id)
+                if not ids:
+                    self._by_event.pop(entry[1], None)
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [(run_at, rid) for rid, (run_at, _) in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def next_run_at(self) -> Optional[int]:
+        while self._heap:
+            run_at, reminder_id = self._heap[0]
+            entry = self._entries.get(reminder_id)
+            if entry is None or entry[0] != run_at:
+                heapq.heappop(self._heap)
+                continue
+            return run_at
+        return None
+
+    def pop_due(self, now: float) -> list[tuple[int, int]]:
+        due = []
+        while True:
+            run_at = self.next_run_at()
+            if run_at is None or run_at > now:
+                return due
+            _, reminder_id = heapq.heappop(self._heap)
+            event_id = self._entries[reminder_id][1]
+            self._discard(reminder_id)
+            due.append((reminder_id, event_id))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def _read_pending(self, db) -> list[tuple[int, int, int, Optional[int]]]:
+        cur = await db.execute("SELECT id, event_id, run_at_epoch, claimed_until FROM reminders WHERE sent=0")
+        rows = await cur.fetchall()
+        await cur.close()
+        self._heap, self._entries, self._by_event = [], {}, {}
+        for reminder_id, event_id, run_at_epoch, claimed_until in rows:
+            # взятое другим (или упавшим) воркером напоминание можно забрать только после истечения claim
+            self.schedule(reminder_id, event_id, max(int(run_at_epoch), (claimed_until or 0) + 1))
+        return rows
+
+    async def schedule_held(self, db, now: int, holder: str):
+        """
+        Наступившие напоминания, которые держит другой воркер: пробуждение на момент истечения его claim,
+        иначе после pop_due они останутся в БД без таймера. Успеет отправить сам — проснёмся вхолостую.
+        """
+        cur = await db.execute(
+            "SELECT id, event_id, claimed_until FROM reminders "
+            "WHERE sent=0 AND run_at_epoch<=? AND claimed_until>=? AND claimed_by!=?",
+            (now, now, holder),
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+        for reminder_id, event_id, claimed_until in rows:
+            self.schedule(reminder_id, event_id, claimed_until + 1)
+
+    async def load(self, db):
+        self.active = True
+        rows = await self._read_pending(db)
+        logging.info("reminder scheduler loaded %s pending reminders", len(rows))
+
+    def stop(self):
+        self.active = False
+        self._heap, self._entries, self._by_event = [], {}, {}
+
+    async def resync(self):
+        # напоминания, созданные другим процессом (роль bot), куча узнаёт только из БД
+        async with pool.connection() as db:
+            await self._read_pending(db)
+        self.resyncs += 1
+
+    async def run(self, process_due: Callable[[], Awaitable[None]], resync_interval: Optional[float] = None):
+        next_resync = time.time() + resync_interval if resync_interval else None
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            if next_resync is not None and now >= next_resync:
+                try:
+                    await self.resync()
+                except Exception:
+                    logging.exception("reminder scheduler: resync failed")
+                next_resync = now + resync_interval
+            run_at = self.next_run_at()
+            if run_at is None or run_at > now:
+                timeout = None if run_at is None else run_at - now
+                if next_resync is not None:
+                    timeout = next_resync - now if timeout is None else min(timeout, next_resync - now)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = self.pop_due(now)
+            self.fired += len(due)
+            try:
+                await process_due()
+            except Exception:
+                logging.exception("reminder scheduler: processing failed, retry in %ss", self.retry_delay)
+                for reminder_id, event_id in due:
+                    self.schedule(reminder_id, event_id, int(now + self.retry_delay))
+
+    def stats(self) -> dict:
+        run_at = self.next_run_at()
+        return {
+            "active": self.active,
+            "pending": len(self._entries),
+            "heap_size": len(self._heap),
+            "next_run_in_s": None if run_at is None else round(run_at - time.time(), 3),
+            "fired": self.fired,
+            "resyncs": self.resyncs,
+        }
+
+
+reminder_scheduler = ReminderScheduler()
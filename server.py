@@ -1,27 +1,68 @@
 import os
+import re
 import json
-import hmac
+import asyncio
 import hashlib
+import hmac
+import logging
 import urllib.parse
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
 from typing import Optional, List
 
-import aiosqlite
 from fastapi import FastAPI, HTTPException, Header, Query
-from fastapi.responses import HTMLResponse, Response
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
 from core import (
-    BOT_TOKEN,
-    DB_PATH,
+    BASE_DIR,
     TZ,
-    make_chat_sig,
-    make_user_sig,
+    INITDATA_MAX_AGE,
+    INITDATA_CACHE_SIZE,
+    INITDATA_CACHE_TTL,
+    FEED_CACHE_SIZE,
+    FEED_MAX_EVENTS,
+    OPT_YES,
+    OPT_MAYBE,
+    OPT_NO,
+    UPCOMING_CACHE_SIZE,
+    STREAM_QUEUE_SIZE,
+    STREAM_HEARTBEAT_SECONDS,
+    STREAM_POLL_SECONDS,
+    STREAM_MAX_CONNECTIONS,
+    STREAM_TOKEN_TTL,
+    METRICS_TOKEN,
+    to_epoch,
+    now_epoch,
+    signer,
     build_poll_link,
     make_ics,
+    make_ics_vevent,
+    make_ics_calendar,
+    event_description,
+)
+from db_pool import pool, init_db, close_db
+from changes import (
+    record_change,
+    get_chat_version,
+    get_chat_versions,
+    get_log_position,
+    read_changes,
+    change_bus,
+    ChatChange,
+    CHANGE_UPDATE,
+    CHANGE_DELETE,
+    CHANGE_VOTE,
 )
-from db_schema import CREATE_SQL
+from scheduler import reminder_scheduler
+from outbound import outbound
+from vote_buffer import vote_buffer
+from poll_index import poll_index
+from outbox import outbox
+from caching import SingleFlight, TTLCache
+from static_page import StaticPage
+from stream import ChangeStream, StreamMessage
 
 app = FastAPI()
 
@@ -31,20 +72,67 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["GET", "POST", "PUT", "DELETE"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
+)
+
+
+index_page = StaticPage(
+    os.path.join(BASE_DIR, "webapp", "index.html"),
+    media_type="text/html; charset=utf-8",
 )
 
 
 @app.on_event("startup")
 async def startup():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.executescript(CREATE_SQL)
-        await db.commit()
+    await init_db()
+    try:
+        index_page.load()
+    except FileNotFoundError:
+        logging.error("webapp/index.html not found")
+    app.state.change_stream_task = asyncio.create_task(change_stream.run())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    task = getattr(app.state, "change_stream_task", None)
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    await vote_buffer.close()
+    await close_db()
+
+
+# Проверенные initData: hash -> (init_data, auth_date, {"user": ...}).
+# Mini App шлёт один и тот же заголовок на каждый запрос, так что HMAC и разбор нужны один раз.
+initdata_cache = TTLCache(INITDATA_CACHE_SIZE, INITDATA_CACHE_TTL)
+_INITDATA_HASH_RE = re.compile(r"(?:^|&)hash=([0-9a-fA-F]+)(?:&|$)")
+
+
+def _check_auth_date(auth_date: int):
+    if INITDATA_MAX_AGE > 0 and now_epoch() - auth_date > INITDATA_MAX_AGE:
+        raise HTTPException(401, "initData expired")
 
 
 def telegram_webapp_verify_initdata(init_data: str) -> dict:
     if not init_data:
         raise HTTPException(401, "Missing initData")
 
+    m = _INITDATA_HASH_RE.search(init_data)
+    if m:
+        cached = initdata_cache.get(m.group(1))
+        # сравниваем строку целиком: hash сам по себе не должен открывать доступ
+        if cached is not None and cached[0] == init_data:
+            _check_auth_date(cached[1])
+            return cached[2]
+
+    received_hash, auth_date, auth = _verify_initdata(init_data)
+    _check_auth_date(auth_date)
+    ttl = INITDATA_MAX_AGE - (now_epoch() - auth_date) if INITDATA_MAX_AGE > 0 else None
+    initdata_cache.set(received_hash, (init_data, auth_date, auth), ttl=ttl)
+    return auth
+
+
+def _verify_initdata(init_data: str) -> tuple[str, int, dict]:
     try:
         parsed = urllib.parse.parse_qs(init_data, strict_parsing=True)
     except Exception:
@@ -63,10 +151,7 @@ def telegram_webapp_verify_initdata(init_data: str) -> dict:
         pairs.append(f"{k}={v}")
     data_check_string = "\n".join(pairs)
 
-    secret_key = hmac.new(b"WebAppData", BOT_TOKEN.encode("utf-8"), hashlib.sha256).digest()
-    computed_hash = hmac.new(secret_key, data_check_string.encode("utf-8"), hashlib.sha256).hexdigest()
-
-    if not hmac.compare_digest(computed_hash, received_hash):
+    if not signer.verify_webapp_hash(data_check_string, received_hash):
         raise HTTPException(401, "Bad initData hash")
 
     user_json = parsed.get("user", [None])[0]
@@ -81,12 +166,16 @@ def telegram_webapp_verify_initdata(init_data: str) -> dict:
     if "id" not in user:
         raise HTTPException(401, "No user.id in initData")
 
-    return {"user": user}
+    try:
+        auth_date = int(parsed["auth_date"][0])
+    except Exception:
+        raise HTTPException(401, "No auth_date in initData")
+
+    return received_hash, auth_date, {"user": user}
 
 
 def verify_chat_sig(chat_id: int, sig: str):
-    exp = make_chat_sig(chat_id)
-    if not sig or not hmac.compare_digest(exp, sig):
+    if not signer.verify_chat_sig(chat_id, sig):
         raise HTTPException(403, "bad signature")
 
 
@@ -119,24 +208,47 @@ class CalendarItem(BaseModel):
     my_vote: Optional[str] = None  # "yes" | "maybe" | "no" | None
 
 
+class CalendarChanges(BaseModel):
+    version: int  # передать как since в следующий запрос
+    reset: bool
+    items: List[CalendarItem]
+    deleted: List[int]
+    window: List[int]  # id текущего окна по порядку
+    stream_token: Optional[str] = None  # для /api/calendar/stream, если пользователь известен
+
+
 @app.get("/event-form", response_class=HTMLResponse)
-async def event_form():
-    path = os.path.join("webapp", "index.html")
-    if not os.path.exists(path):
+async def event_form(
+    accept_encoding: str = Header(default="", alias="Accept-Encoding"),
+    if_none_match: str = Header(default="", alias="If-None-Match"),
+):
+    try:
+        return index_page.response(accept_encoding, if_none_match)
+    except FileNotFoundError:
         raise HTTPException(500, "webapp/index.html not found")
-    with open(path, "r", encoding="utf-8") as f:
-        return HTMLResponse(f.read())
 
 
-@app.get("/api/event/{event_id}", response_model=EventView)
-async def api_get_event(event_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+# Одинаковые одновременные чтения (одно событие, список чата, лента) делят один запрос к БД.
+# Функции, которые отдаются во flight, берут соединение сами: ждущие не держат своих.
+event_flight = SingleFlight()
+upcoming_flight = SingleFlight()
+feed_flight = SingleFlight()
+
+
+async def _fetch_event(event_id: int):
+    async with pool.connection() as db:
         cur = await db.execute(
             "SELECT id, chat_id, dt_iso, title, cost, location, details FROM events WHERE id=?",
             (event_id,),
         )
         row = await cur.fetchone()
         await cur.close()
+    return row
+
+
+@app.get("/api/event/{event_id}", response_model=EventView)
+async def api_get_event(event_id: int):
+    row = await event_flight.do(event_id, lambda: _fetch_event(event_id))
 
     if not row:
         raise HTTPException(404, "event not found")
@@ -174,7 +286,7 @@ async def api_update_event(
     except Exception:
         raise HTTPException(400, "dt_iso must be ISO with timezone, e.g. 2026-01-10T19:00:00+02:00")
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.connection(write=True) as db:
         cur = await db.execute(
             "SELECT creator_user_id, chat_id FROM events WHERE id=?",
             (event_id,),
@@ -193,18 +305,29 @@ async def api_update_event(
             raise HTTPException(401, "Missing initData or user signature")
 
         if x_telegram_initdata == "" and user_sig:
-            expected = make_user_sig(int(chat_id), int(user_id_final))
-            if not hmac.compare_digest(expected, user_sig):
+            if not signer.verify_user_sig(int(chat_id), int(user_id_final), user_sig):
                 raise HTTPException(403, "bad user signature")
 
         if int(creator_user_id) != int(user_id_final):
             raise HTTPException(403, "not allowed")
 
         await db.execute(
-            "UPDATE events SET dt_iso=?, title=?, cost=?, location=?, details=? WHERE id=?",
-            (patch.dt_iso, patch.title, patch.cost, patch.location, patch.details or "", event_id),
+            "UPDATE events SET dt_iso=?, dt_utc_epoch=?, title=?, cost=?, location=?, details=?, "
+            "revision=revision+1, updated_at_epoch=? WHERE id=?",
+            (
+                patch.dt_iso,
+                to_epoch(dt),
+                patch.title,
+                patch.cost,
+                patch.location,
+                patch.details or "",
+                now_epoch(),
+                event_id,
+            ),
         )
+        change = await record_change(db, chat_id, event_id, CHANGE_UPDATE)
         await db.commit()
+    change_bus.publish(change)
 
     return {"ok": True}
 
@@ -223,7 +346,7 @@ async def api_delete_event(
     elif user_id is not None and user_sig:
         user_id_final = int(user_id)
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with pool.connection(write=True) as db:
         cur = await db.execute(
             "SELECT creator_user_id, chat_id, poll_id FROM events WHERE id=?",
             (event_id,),
@@ -242,8 +365,7 @@ async def api_delete_event(
             raise HTTPException(401, "Missing initData or user signature")
 
         if x_telegram_initdata == "" and user_sig:
-            expected = make_user_sig(int(chat_id), int(user_id_final))
-            if not hmac.compare_digest(expected, user_sig):
+            if not signer.verify_user_sig(int(chat_id), int(user_id_final), user_sig):
                 raise HTTPException(403, "bad user signature")
 
         if int(creator_user_id) != int(user_id_final):
@@ -253,97 +375,315 @@ async def api_delete_event(
         if poll_id:
             await db.execute("DELETE FROM votes WHERE poll_id=?", (poll_id,))
         await db.execute("DELETE FROM events WHERE id=?", (event_id,))
+        change = await record_change(db, chat_id, event_id, CHANGE_DELETE)
         await db.commit()
+    change_bus.publish(change)
+    reminder_scheduler.cancel_event(event_id)
+    poll_index.discard(poll_id)
 
     return {"ok": True}
 
+
+# Предстоящие события чата без пользовательских данных: chat_id -> (version, today_start, [(poll_id, item)]).
+# Держим до UPCOMING_CACHE_LIMIT событий (максимальный limit запроса), limit — срез из кэша.
+# Сбрасывается по change_bus; изменения из других процессов ловит сравнение версии чата.
+UPCOMING_CACHE_LIMIT = 200
+upcoming_cache = TTLCache(UPCOMING_CACHE_SIZE, 3600)
+upcoming_stats = {"not_modified": 0}
+
+_VOTE_NAMES = {OPT_YES: "yes", OPT_MAYBE: "maybe", OPT_NO: "no"}
+
+
+_ITEM_COLUMNS = "id, dt_iso, title, cost, location, details, poll_message_id, poll_id"
+
+
+def _calendar_base(chat_id: int, row) -> tuple[str, dict]:
+    eid, dt_iso, title, cost, location, details, poll_mid, poll_id = row
+    return poll_id, {
+        "id": eid,
+        "dt_iso": dt_iso,
+        "title": title,
+        "cost": cost,
+        "location": location,
+        "details": details,
+        "poll_link": build_poll_link(chat_id, poll_mid),
+    }
+
+
+async def _load_upcoming(chat_id: int, today_start: int) -> list[tuple[str, dict]]:
+    async with pool.connection() as db:
+        cur = await db.execute(
+            f"""
+            SELECT {_ITEM_COLUMNS}
+            FROM events
+            WHERE chat_id = ? AND dt_utc_epoch >= ?
+            ORDER BY dt_utc_epoch ASC, id ASC
+            LIMIT ?
+            """,
+            (chat_id, today_start, UPCOMING_CACHE_LIMIT),
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+    return [_calendar_base(chat_id, row) for row in rows]
+
+
+async def _upcoming_base(chat_id: int, version: int, today_start: int) -> list[tuple[str, dict]]:
+    cached = upcoming_cache.get(chat_id)
+    if cached is not None and cached[0] == version and cached[1] == today_start:
+        return cached[2]
+    upcoming = await upcoming_flight.do(
+        (chat_id, version, today_start), lambda: _load_upcoming(chat_id, today_start)
+    )
+    upcoming_cache.set(chat_id, (version, today_start, upcoming))
+    return upcoming
+
+
+async def _user_votes(db, user_id: int, poll_ids: list[str]) -> dict[str, Optional[int]]:
+    cur = await db.execute(
+        f"SELECT poll_id, option_id FROM votes WHERE user_id = ? AND poll_id IN ({','.join('?' * len(poll_ids))})",
+        (user_id, *poll_ids),
+    )
+    rows = await cur.fetchall()
+    await cur.close()
+    return dict(rows)
+
+
+async def _with_votes(
+    base: list[tuple[str, dict]],
+    user_id: Optional[int],
+    pending_votes: dict[str, Optional[int]],
+) -> list[CalendarItem]:
+    votes: dict[str, Optional[int]] = {}
+    if user_id is not None and base:
+        async with pool.connection() as db:
+            votes = await _user_votes(db, user_id, [poll_id for poll_id, _ in base])
+
+    # голоса, ещё не записанные из буфера, важнее прочитанных из БД
+    votes.update(pending_votes)
+
+    # option_id: 0=yes,1=maybe,2=no
+    return [
+        CalendarItem(**item, my_vote=_VOTE_NAMES.get(votes.get(poll_id)))
+        for poll_id, item in base
+    ]
+
+
+def _calendar_user_id(
+    chat_id: int,
+    x_telegram_initdata: str,
+    user_id: Optional[int],
+    user_sig: Optional[str],
+) -> Optional[int]:
+    if x_telegram_initdata:
+        auth = telegram_webapp_verify_initdata(x_telegram_initdata)
+        return int(auth["user"]["id"])
+    if user_id is not None and user_sig:
+        if not signer.verify_user_sig(chat_id, user_id, user_sig):
+            raise HTTPException(403, "bad user signature")
+        return int(user_id)
+    return None
+
+
 @app.get("/api/calendar/upcoming", response_model=List[CalendarItem])
 async def api_calendar_upcoming(
     chat_id: int = Query(...),
     sig: str = Query(...),
-    limit: int = Query(50, ge=1, le=200),
+    limit: int = Query(50, ge=1, le=UPCOMING_CACHE_LIMIT),
     user_id: Optional[int] = Query(default=None),
     user_sig: Optional[str] = Query(default=None),
     x_telegram_initdata: str = Header(default="", alias="X-Telegram-InitData"),
+    if_none_match: str = Header(default="", alias="If-None-Match"),
+    response: Response = None,
 ):
     """
     Возвращает ближайшие события + голос текущего пользователя (my_vote).
     Требует:
       - chat_id + sig (подпись от бота)
       - initData необязательно (если нет, my_vote будет пустой)
+    ETag — от версий чата (события и голоса) и пользователя: повторный запрос без изменений
+    получает 304, не трогая ни кэш, ни голоса.
     """
     verify_chat_sig(chat_id, sig)
-    user_id_final = None
-    if x_telegram_initdata:
-        auth = telegram_webapp_verify_initdata(x_telegram_initdata)
-        user_id_final = int(auth["user"]["id"])
-    elif user_id is not None and user_sig:
-        expected = make_user_sig(chat_id, user_id)
-        if not hmac.compare_digest(expected, user_sig):
-            raise HTTPException(403, "bad user signature")
-        user_id_final = int(user_id)
+    user_id_final = _calendar_user_id(chat_id, x_telegram_initdata, user_id, user_sig)
+
+    # Окно «сегодня и позже» считаем от московской полуночи (индекс chat_id, dt_utc_epoch)
+    today_start = _today_start_epoch()
+
+    # версии читаем до событий: если запись проскочит между запросами, кэш просто пересоберётся,
+    # а клиент получит более новые данные со старым ETag и перезапросит их ещё раз
+    async with pool.connection() as db:
+        version, vote_version = await get_chat_versions(db, chat_id)
+
+    etag_key = (chat_id, version, vote_version, user_id_final, limit, today_start)
+    etag = '"' + hashlib.sha256(repr(etag_key).encode("utf-8")).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    # голоса из буфера ещё не отражены в vote_version — пока они есть, 304 не отдаём
+    pending_votes = vote_buffer.pending_for_user(user_id_final) if user_id_final is not None else {}
+    if if_none_match and not pending_votes and _etag_matches(etag, if_none_match):
+        upcoming_stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    upcoming = await _upcoming_base(chat_id, version, today_start)
+    return await _with_votes(upcoming[:limit], user_id_final, pending_votes)
+
+
+@app.get("/api/calendar/changes", response_model=CalendarChanges)
+async def api_calendar_changes(
+    chat_id: int = Query(...),
+    sig: str = Query(...),
+    since: Optional[int] = Query(default=None, ge=0),
+    limit: int = Query(50, ge=1, le=UPCOMING_CACHE_LIMIT),
+    user_id: Optional[int] = Query(default=None),
+    user_sig: Optional[str] = Query(default=None),
+    x_telegram_initdata: str = Header(default="", alias="X-Telegram-InitData"),
+):
+    """
+    Дельта к списку предстоящих событий (первые limit, как /api/calendar/upcoming)
+    после версии since (version из прошлого ответа):
+      - items — события окна, добавленные или изменённые после since, а также те, где поменялся голос пользователя;
+      - deleted — id изменённых после since событий, которых в окне больше нет (удалены, перенесены за limit);
+      - window — id всего текущего окна по порядку: всё, чего в нём нет (в том числе ушедшее в прошлое),
+        клиент выбрасывает; если какого-то id из window у клиента нет, нужен полный список.
+    Без since (первая загрузка), если журнал за since уже вычищен или since из чужой базы — reset=true,
+    items содержит всё окно, локальную копию нужно заменить.
+    """
+    verify_chat_sig(chat_id, sig)
+    user_id_final = _calendar_user_id(chat_id, x_telegram_initdata, user_id, user_sig)
+    today_start = _today_start_epoch()
+    pending_votes = vote_buffer.pending_for_user(user_id_final) if user_id_final is not None else {}
+
+    # позицию журнала читаем до данных: изменение, проскочившее между запросами,
+    # придёт ещё раз в следующей дельте — применять его повторно безопасно
+    async with pool.connection() as db:
+        position, floor = await get_log_position(db, chat_id)
+        version, _ = await get_chat_versions(db, chat_id)
+        reset = since is None or since < floor or since > position
+        changes = [] if reset else await read_changes(db, chat_id, since, user_id_final)
+
+    upcoming = (await _upcoming_base(chat_id, version, today_start))[:limit]
+    window = [item["id"] for _, item in upcoming]
+    # initData в URL потока не передаём (логи): вместо неё короткоживущий токен
+    stream_token = None
+    if user_id_final is not None:
+        stream_token = signer.stream_token(chat_id, user_id_final, now_epoch() + STREAM_TOKEN_TTL)
+    if reset:
+        items = await _with_votes(upcoming, user_id_final, pending_votes)
+        return CalendarChanges(
+            version=position, reset=True, items=items, deleted=[], window=window, stream_token=stream_token
+        )
+
+    # как именно менялось событие, неважно: актуальное состояние берём из окна
+    changed = {eid for eid, _ in changes}
+    items = await _with_votes(
+        [(poll_id, item) for poll_id, item in upcoming if item["id"] in changed],
+        user_id_final,
+        pending_votes,
+    )
+    deleted = sorted(changed.difference(window))
+    return CalendarChanges(
+        version=position, reset=False, items=items, deleted=deleted, window=window, stream_token=stream_token
+    )
+
 
-    user_id_param = user_id_final if user_id_final is not None else -1
+async def _stream_messages(db, rows: list[tuple]) -> list[StreamMessage]:
+    """Сообщения SSE по пачке журнала: на событие — одно сообщение каждого вида, с seq последней записи."""
+    latest: dict[tuple, tuple] = {}
+    for row in rows:
+        _, _, event_id, action, user_id = row
+        if action == CHANGE_VOTE:
+            latest[("my_vote", event_id, user_id)] = row
+        else:
+            latest[("event", event_id)] = row
 
-    async with aiosqlite.connect(DB_PATH) as db:
+    event_ids = [key[1] for key in latest if key[0] == "event"]
+    voted_ids = list({key[1] for key in latest if key[0] == "my_vote"})
+    voters = list({key[2] for key in latest if key[0] == "my_vote"})
+
+    items = {}
+    if event_ids:
         cur = await db.execute(
-            """
-            SELECT
-              e.id, e.dt_iso, e.title, e.cost, e.location, e.details, e.poll_message_id, e.poll_id,
-              v.option_id
-            FROM events e
-            LEFT JOIN votes v
-              ON v.poll_id = e.poll_id AND v.user_id = ?
-            WHERE e.chat_id = ?
-            ORDER BY e.dt_iso ASC
-            """,
-            (user_id_param, chat_id),
+            f"SELECT {_ITEM_COLUMNS}, chat_id FROM events WHERE id IN ({','.join('?' * len(event_ids))})",
+            event_ids,
         )
-        rows = await cur.fetchall()
+        items = {row[0]: _calendar_base(row[-1], row[:-1])[1] for row in await cur.fetchall()}
         await cur.close()
 
-    now_dt = datetime.now(tz=TZ)
-    today = now_dt.date()
-    items: List[CalendarItem] = []
-    for (eid, dt_iso, title, cost, location, details, poll_mid, poll_id, option_id) in rows:
-        event_dt = None
-        try:
-            event_dt = datetime.fromisoformat(dt_iso)
-            if event_dt.tzinfo is None:
-                event_dt = event_dt.replace(tzinfo=TZ)
-            event_dt = event_dt.astimezone(TZ)
-        except Exception:
-            event_dt = None
-
-        poll_link = build_poll_link(chat_id, poll_mid)
-
-        my_vote = None
-        # option_id: 0=yes,1=maybe,2=no
-        if option_id is not None:
-            if int(option_id) == 0:
-                my_vote = "yes"
-            elif int(option_id) == 1:
-                my_vote = "maybe"
-            elif int(option_id) == 2:
-                my_vote = "no"
-
-        item = CalendarItem(
-            id=eid,
-            dt_iso=dt_iso,
-            title=title,
-            cost=cost,
-            location=location,
-            details=details,
-            poll_link=poll_link,
-            my_vote=my_vote
+    my_votes: dict[tuple[int, int], Optional[int]] = {}
+    if voted_ids:
+        cur = await db.execute(
+            f"SELECT e.id, v.user_id, v.option_id FROM events e JOIN votes v ON v.poll_id = e.poll_id "
+            f"WHERE e.id IN ({','.join('?' * len(voted_ids))}) AND v.user_id IN ({','.join('?' * len(voters))})",
+            (*voted_ids, *voters),
         )
-        if event_dt is not None and event_dt.date() < today:
-            continue
-        items.append(item)
-        if len(items) >= limit:
-            break
+        my_votes = {(event_id, user_id): option_id for event_id, user_id, option_id in await cur.fetchall()}
+        await cur.close()
+
+    messages = []
+    for key, (seq, chat_id, event_id, _, user_id) in latest.items():
+        if key[0] == "event":
+            if event_id in items:
+                messages.append(StreamMessage(seq, chat_id, None, "upsert", items[event_id]))
+            else:
+                messages.append(StreamMessage(seq, chat_id, None, "delete", {"id": event_id}))
+        else:
+            vote = _VOTE_NAMES.get(my_votes.get((event_id, user_id)))
+            messages.append(StreamMessage(seq, chat_id, user_id, "my_vote", {"id": event_id, "my_vote": vote}))
+    messages.sort(key=lambda message: message.seq)
+    return messages
+
+
+change_stream = ChangeStream(
+    _stream_messages,
+    queue_size=STREAM_QUEUE_SIZE,
+    poll_interval=STREAM_POLL_SECONDS,
+    max_subscribers=STREAM_MAX_CONNECTIONS,
+)
+# запись в этом процессе — читаем журнал сразу, не дожидаясь poll_interval
+change_bus.subscribe(lambda change: change_stream.notify())
+
+
+@app.get("/api/calendar/stream")
+async def api_calendar_stream(
+    chat_id: int = Query(...),
+    sig: str = Query(...),
+    token: Optional[str] = Query(default=None),
+):
+    """
+    Server-Sent Events с изменениями чата: upsert / delete событий и my_vote (только самому
+    проголосовавшему; счётчики голосов Mini App не показывает, поэтому чужие голоса не рассылаем). EventSource не умеет заголовки, а initData в URL
+    осела бы в логах, поэтому пользователя задаёт короткоживущий token из /api/calendar/changes
+    (без него — только общие события чата). Пропущенное за время разрыва клиент догоняет
+    через /api/calendar/changes; resync — то же самое, нас отключили за медленное чтение.
+    """
+    verify_chat_sig(chat_id, sig)
+    user_id_final = None
+    if token:
+        user_id_final = signer.verify_stream_token(chat_id, token, now_epoch())
+        if user_id_final is None:
+            raise HTTPException(403, "bad or expired stream token")
+    sub = change_stream.subscribe(chat_id, user_id_final)
+    if sub is None:
+        raise HTTPException(503, "too many streams")
+
+    async def events():
+        try:
+            yield "retry: 5000\n\n"
+            while not sub.overflowed:
+                try:
+                    yield await asyncio.wait_for(sub.queue.get(), STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+            yield "event: resync\ndata: {}\n\n"
+        finally:
+            change_stream.unsubscribe(sub)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    return items
 
 @app.get("/api/calendar/ics")
 async def api_calendar_ics(
@@ -364,34 +704,22 @@ async def api_calendar_ics(
     else:
         raise HTTPException(401, "Missing initData or user signature")
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT chat_id, dt_iso, title, cost, location, details FROM events WHERE id=?",
-            (event_id,),
-        )
-        row = await cur.fetchone()
-        await cur.close()
+    row = await event_flight.do(event_id, lambda: _fetch_event(event_id))
 
     if not row:
         raise HTTPException(404, "event not found")
 
-    chat_id, dt_iso, title, cost, location, details = row
+    _, chat_id, dt_iso, title, cost, location, details = row
 
     if x_telegram_initdata == "" and user_sig:
-        expected = make_user_sig(int(chat_id), int(user_id_final))
-        if not hmac.compare_digest(expected, user_sig):
+        if not signer.verify_user_sig(int(chat_id), int(user_id_final), user_sig):
             raise HTTPException(403, "bad user signature")
     elif x_telegram_initdata == "" and chat_sig:
-        expected = make_chat_sig(int(chat_id))
-        if not hmac.compare_digest(expected, chat_sig):
+        if not signer.verify_chat_sig(int(chat_id), chat_sig):
             raise HTTPException(403, "bad chat signature")
 
     dt = datetime.fromisoformat(dt_iso).astimezone(TZ)
-    description = f"Стоимость: {cost}"
-    if (details or "").strip():
-        description += f"\n\n{details.strip()}"
-
-    ics_text = make_ics(dt, title, location, description)
+    ics_text = make_ics(dt, title, location, event_description(cost, details))
     filename = f"event_{event_id}.ics"
     headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
     return Response(
@@ -399,3 +727,230 @@ async def api_calendar_ics(
         media_type="text/calendar; charset=utf-8; method=PUBLISH",
         headers=headers,
     )
+
+
+# Отрендеренные ленты: ключ -> (отпечаток состояния, body).
+# Лента пересобирается, только если сменился отпечаток (версия чата, голоса) или наступили новые сутки.
+feed_cache = TTLCache(FEED_CACHE_SIZE, 24 * 3600)
+user_feed_cache = TTLCache(FEED_CACHE_SIZE, 24 * 3600)
+
+
+@change_bus.subscribe
+def _drop_chat_caches(change: ChatChange):
+    if change.action == CHANGE_VOTE:
+        return  # голоса не входят ни в список событий, ни в ленту чата
+    # чтение события, начатое до commit, вернуло бы старую строку
+    event_flight.forget(change.event_id)
+    upcoming_cache.pop(change.chat_id)
+    feed_cache.pop(change.chat_id)
+
+
+def _etag_matches(etag: str, if_none_match: str) -> bool:
+    tags = {t.strip() for t in if_none_match.split(",")}
+    return etag in tags or "*" in tags
+
+
+def _not_modified(etag: str, last_modified: int, if_none_match: str, if_modified_since: str) -> bool:
+    # If-None-Match главнее: If-Modified-Since смотрим, только если ETag не прислали
+    if if_none_match:
+        return _etag_matches(etag, if_none_match)
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            return False
+        return last_modified <= int(since.timestamp())
+    return False
+
+
+def _today_start_epoch() -> int:
+    return to_epoch(datetime.now(tz=TZ).replace(hour=0, minute=0, second=0, microsecond=0))
+
+
+def _feed_vevent(eid, dt_iso, title, cost, location, details, revision, updated_at_epoch, status=None) -> list[str]:
+    return make_ics_vevent(
+        datetime.fromisoformat(dt_iso).astimezone(TZ),
+        title,
+        location,
+        event_description(cost, details),
+        # UID должен быть стабильным, иначе календарь задвоит событие после правки;
+        # правку он узнаёт по SEQUENCE и DTSTAMP (время последнего изменения)
+        uid=f"event-{eid}@telegram-meeting-bot",
+        dtstamp=datetime.fromtimestamp(updated_at_epoch, tz=timezone.utc),
+        status=status,
+        sequence=revision,
+    )
+
+
+async def _feed_response(
+    cache: TTLCache,
+    key,
+    fingerprint: tuple,
+    last_modified: int,
+    render,
+    if_none_match: str,
+    if_modified_since: str,
+) -> Response:
+    etag = '"' + hashlib.sha256(repr((key, fingerprint)).encode("utf-8")).hexdigest()[:32] + '"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(last_modified, usegmt=True),
+        "Cache-Control": "private, no-cache",
+    }
+    if _not_modified(etag, last_modified, if_none_match, if_modified_since):
+        return Response(status_code=304, headers=headers)
+
+    cached = cache.get(key)
+    if cached is not None and cached[0] == fingerprint:
+        body = cached[1]
+    else:
+        async def run() -> str:
+            async with pool.connection() as db:
+                return await render(db)
+
+        body = await feed_flight.do((id(cache), key, fingerprint), run)
+        cache.set(key, (fingerprint, body))
+
+    return Response(content=body, media_type="text/calendar; charset=utf-8", headers=headers)
+
+
+@app.get("/api/calendar/feed.ics")
+async def api_calendar_feed(
+    chat_id: int = Query(...),
+    sig: str = Query(...),
+    if_none_match: str = Header(default="", alias="If-None-Match"),
+    if_modified_since: str = Header(default="", alias="If-Modified-Since"),
+):
+    """
+    Подписка (webcal) на все предстоящие события чата одним VCALENDAR.
+    ETag/Last-Modified — от версии чата, так что опрос без изменений стоит одного SELECT.
+    """
+    verify_chat_sig(chat_id, sig)
+    today_start = _today_start_epoch()
+
+    async def render(db) -> str:
+        cur = await db.execute(
+            """
+            SELECT id, dt_iso, title, cost, location, details, revision, updated_at_epoch
+            FROM events
+            WHERE chat_id = ? AND dt_utc_epoch >= ?
+            ORDER BY dt_utc_epoch ASC, id ASC
+            LIMIT ?
+            """,
+            (chat_id, today_start, FEED_MAX_EVENTS),
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+        return make_ics_calendar([_feed_vevent(*row) for row in rows], name="Квизы")
+
+    async with pool.connection() as db:
+        version, updated_at = await get_chat_version(db, chat_id)
+    # смена суток тоже меняет ленту: прошедшие события из неё выпадают
+    return await _feed_response(
+        feed_cache,
+        chat_id,
+        (version, today_start),
+        max(updated_at, today_start),
+        render,
+        if_none_match,
+        if_modified_since,
+    )
+
+
+@app.get("/api/calendar/my.ics")
+async def api_calendar_user_feed(
+    user_id: int = Query(...),
+    sig: str = Query(...),
+    if_none_match: str = Header(default="", alias="If-None-Match"),
+    if_modified_since: str = Header(default="", alias="If-Modified-Since"),
+):
+    """
+    Личная подписка: предстоящие события из всех чатов, где пользователь ответил «да» или «может быть».
+    Отпечаток считается по голосам пользователя (индекс votes(user_id)) и версиям их чатов.
+    """
+    if not signer.verify_user_feed_sig(user_id, sig):
+        raise HTTPException(403, "bad signature")
+    today_start = _today_start_epoch()
+
+    async def render(db) -> str:
+        cur = await db.execute(
+            """
+            SELECT e.id, e.dt_iso, e.title, e.cost, e.location, e.details, e.revision, e.updated_at_epoch, v.option_id
+            FROM votes v
+            JOIN events e ON e.poll_id = v.poll_id
+            WHERE v.user_id = ? AND v.option_id IN (?, ?) AND e.dt_utc_epoch >= ?
+            ORDER BY e.dt_utc_epoch ASC, e.id ASC
+            LIMIT ?
+            """,
+            (user_id, OPT_YES, OPT_MAYBE, today_start, FEED_MAX_EVENTS),
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+        vevents = [
+            _feed_vevent(*row[:8], status="CONFIRMED" if row[8] == OPT_YES else "TENTATIVE")
+            for row in rows
+        ]
+        return make_ics_calendar(vevents, name="Мои квизы")
+
+    async with pool.connection() as db:
+        # Любое изменение ленты меняет хотя бы одно из: число голосов, время последнего голоса,
+        # версию чата одного из событий.
+        cur = await db.execute(
+            """
+            SELECT COUNT(*), MAX(v.updated_at_iso), COALESCE(SUM(cv.version), 0), COALESCE(MAX(cv.updated_at_epoch), 0)
+            FROM votes v
+            JOIN events e ON e.poll_id = v.poll_id
+            LEFT JOIN chat_versions cv ON cv.chat_id = e.chat_id
+            WHERE v.user_id = ? AND e.dt_utc_epoch >= ?
+            """,
+            (user_id, today_start),
+        )
+        votes_count, last_vote_iso, versions_sum, chats_updated_at = await cur.fetchone()
+        await cur.close()
+
+    last_modified = max(today_start, chats_updated_at)
+    if last_vote_iso:
+        last_modified = max(last_modified, to_epoch(datetime.fromisoformat(last_vote_iso)))
+    return await _feed_response(
+        user_feed_cache,
+        user_id,
+        (votes_count, last_vote_iso, versions_sum, today_start),
+        last_modified,
+        render,
+        if_none_match,
+        if_modified_since,
+    )
+
+
+@app.get("/api/metrics")
+async def api_metrics(x_metrics_token: str = Header(default="", alias="X-Metrics-Token")):
+    # внутренности пула, кэшей и очередей наружу без токена не отдаём
+    if not hmac.compare_digest(x_metrics_token, METRICS_TOKEN):
+        raise HTTPException(401, "bad metrics token")
+    webhook = getattr(app.state, "webhook", None)
+    scheduler_lease = getattr(app.state, "scheduler_lease", None)
+    return {
+        "db_pool": pool.stats(),
+        "reminder_scheduler": reminder_scheduler.stats(),
+        "telegram_outbound": outbound.stats(),
+        "vote_buffer": vote_buffer.stats(),
+        "outbox": outbox.stats(),
+        "poll_index": poll_index.stats(),
+        "initdata_cache": initdata_cache.stats(),
+        "index_page": index_page.stats(),
+        "webhook": webhook.stats() if webhook is not None else None,
+        "scheduler_lease": scheduler_lease.stats() if scheduler_lease is not None else None,
+        "feed_cache": feed_cache.stats(),
+        "upcoming_cache": upcoming_cache.stats(),
+        "upcoming": upcoming_stats,
+        "singleflight": {
+            "event": event_flight.stats(),
+            "upcoming": upcoming_flight.stats(),
+            "feed": feed_flight.stats(),
+        },
+        "change_bus": change_bus.stats(),
+        "change_stream": change_stream.stats(),
+        "user_feed_cache": user_feed_cache.stats(),
+    }
@@ -0,0 +1,113 @@
+import gzip
+import hashlib
+import logging
+import os
+import time
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него отдаём gzip/identity
+    brotli = None
+
+from fastapi.responses import Response
+
+
+class StaticPage:
+    """
+    Файл, который держим в памяти вместе с заранее сжатыми вариантами (br, gzip).
+    Перечитывается при смене mtime (stat не чаще раза в check_interval секунд).
+    Отдаётся с сильным ETag (свой для каждого варианта), 304 на If-None-Match.
+    """
+
+    def __init__(self, path: str, media_type: str, cache_control: str = "no-cache", check_interval: float = 1.0):
+        self.path = path
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.check_interval = check_interval
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._variants: dict[str, tuple[bytes, str]] = {}  # encoding -> (body, etag)
+        self.loads = 0
+        self.not_modified = 0
+
+    def load(self):
+        st = os.stat(self.path)
+        with open(self.path, "rb") as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        variants = {"identity": (body, f'"{digest}"')}
+        variants["gzip"] = (gzip.compress(body, compresslevel=9, mtime=0), f'"{digest}-gz"')
+        if brotli is not None:
+            variants["br"] = (brotli.compress(body, quality=11), f'"{digest}-br"')
+        self._variants = variants
+        self._mtime = st.st_mtime
+        self._checked_at = time.monotonic()
+        self.loads += 1
+        logging.info(
+            "static page loaded: path=%s size=%s variants=%s",
+            self.path,
+            len(body),
+            {k: len(v[0]) for k, v in variants.items()},
+        )
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._variants and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        if not self._variants or os.stat(self.path).st_mtime != self._mtime:
+            self.load()
+
+    @staticmethod
+    def _accepted(accept_encoding: str) -> set[str]:
+        accepted = set()
+        for part in (accept_encoding or "").split(","):
+            token, _, params = part.strip().partition(";")
+            token = token.strip().lower()
+            if not token:
+                continue
+            q = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            if q > 0:
+                accepted.add(token)
+        return accepted
+
+    def response(self, accept_encoding: str = "", if_none_match: str = "") -> Response:
+        self._refresh()
+
+        accepted = self._accepted(accept_encoding)
+        encoding = "identity"
+        for candidate in ("br", "gzip"):
+            if candidate in self._variants and (candidate in accepted or "*" in accepted):
+                encoding = candidate
+                break
+        body, etag = self._variants[encoding]
+
+        headers = {
+            "ETag": etag,
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+
+        if if_none_match:
+            tags = {t.strip() for t in if_none_match.split(",")}
+            if etag in tags or "*" in tags:
+                self.not_modified += 1
+                return Response(status_code=304, headers=headers)
+
+        return Response(content=body, media_type=self.media_type, headers=headers)
+
+    def stats(self) -> dict:
+        return {
+            "loads": self.loads,
+            "not_modified": self.not_modified,
+            "sizes": {k: len(v[0]) for k, v in self._variants.items()},
+        }
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+from db_pool import pool
+
+
+class StreamMessage(NamedTuple):
+    seq: int
+    chat_id: int
+    user_id: Optional[int]  # None — всем подписчикам чата, иначе только этому пользователю
+    event: str
+    data: dict
+
+    def encode(self) -> str:
+        return f"id: {self.seq}\nevent: {self.event}\ndata: {json.dumps(self.data, ensure_ascii=False)}\n\n"
+
+
+# (db, строки журнала (seq, chat_id, event_id, action, user_id)) -> сообщения для подписчиков
+Builder = Callable[[object, list[tuple]], Awaitable[list[StreamMessage]]]
+
+
+class Subscription:
+    __slots__ = ("chat_id", "user_id", "queue", "overflowed")
+
+    def __init__(self, chat_id: int, user_id: Optional[int], queue_size: int):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.queue: asyncio.Queue[str] = asyncio.Queue(queue_size)
+        self.overflowed = False
+
+
+class ChangeStream:
+    """
+    Живые изменения календаря для SSE (/api/calendar/stream).
+    Источник — журнал change_log: один читатель на процесс забирает новые записи
+    (сразу по notify(), если запись сделана в этом процессе, иначе раз в poll_interval),
+    строит сообщения один раз на пачку и раскладывает по очередям подписчиков чата.
+    Очередь подписчика ограничена: кто не успевает читать, помечается overflowed и отключается —
+    клиент переподключится и догонит пропущенное через /api/calendar/changes.
+    """
+
+    def __init__(
+        self,
+        build: Builder,
+        queue_size: int,
+        poll_interval: float,
+        max_subscribers: int,
+        batch_size: int = 500,
+    ):
+        self.build = build
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.max_subscribers = max_subscribers
+        self.batch_size = batch_size
+        self._chats: dict[int, set[Subscription]] = {}
+        self._subscribers = 0
+        self._position: Optional[int] = None
+        self._wakeup = asyncio.Event()
+
+        self.delivered = 0
+        self.overflows = 0
+        self.rejected = 0
+
+    def subscribe(self, chat_id: int, user_id: Optional[int]) -> Optional[Subscription]:
+        """None — подписчиков уже max_subscribers."""
+        if self._subscribers >= self.max_subscribers:
+            self.rejected += 1
+            return None
+        sub = Subscription(chat_id, user_id, self.queue_size)
+        self._chats.setdefault(chat_id, set()).add(sub)
+        self._subscribers += 1
+        if self._subscribers == 1:
+            # первый подписчик: будим читателя, чтобы он запомнил текущую позицию журнала
+            self._wakeup.set()
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        subs = self._chats.get(sub.chat_id)
+        if subs is None or sub not in subs:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self._chats[sub.chat_id]
+        self._subscribers -= 1
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _deliver(self, message: StreamMessage):
+        text = message.encode()
+        for sub in list(self._chats.get(message.chat_id, ())):
+            if message.user_id is not None and sub.user_id != message.user_id:
+                continue
+            try:
+                sub.queue.put_nowait(text)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                # медленный клиент: не копим для него память, отключаем
+                sub.overflowed = True
+                self.overflows += 1
+                self.unsubscribe(sub)
+
+    def _watched(self, row: tuple) -> bool:
+        """Есть ли кому доставить запись журнала: голос (user_id задан) нужен только самому проголосовавшему."""
+        subs = self._chats.get(row[1])
+        if not subs:
+            return False
+        user_id = row[4]
+        return user_id is None or any(sub.user_id == user_id for sub in subs)
+
+    async def _poll(self) -> int:
+        async with pool.connection() as db:
+            if self._position is None:
+                # появились подписчики: читаем журнал с текущего конца, прошлое клиент берёт из дельты
+                cur = await db.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log")
+                (self._position,) = await cur.fetchone()
+                await cur.close()
+                return 0
+
+            cur = await db.execute(
+                "SELECT seq, chat_id, event_id, action, user_id FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?",
+                (self._position, self.batch_size),
+            )
+            rows = await cur.fetchall()
+            await cur.close()
+            if not rows:
+                return 0
+            watched = [row for row in rows if self._watched(row)]
+            messages = await self.build(db, watched) if watched else []
+
+        self._position = rows[-1][0]
+        for message in messages:
+            self._deliver(message)
+        return len(rows)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._chats:
+                # без подписчиков в БД не ходим вовсе; позицию возьмём заново при первом подписчике
+                self._position = None
+                await self._wakeup.wait()
+                continue
+            try:
+                if await self._poll() >= self.batch_size:
+                    continue
+            except Exception:
+                logging.exception("change stream: poll failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": self._subscribers,
+            "chats": len(self._chats),
+            "position": self._position,
+            "delivered": self.delivered,
+            "overflows": self.overflows,
+            "rejected": self.rejected,
+        }
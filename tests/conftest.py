@@ -0,0 +1,33 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "123456789:AAtest-token-for-smoke-tests")
+
+from db_pool import pool, close_db  # noqa: E402
+
+
+@pytest.fixture
+def run(tmp_path):
+    """
+    Запуск сценария в своём цикле событий на пустой БД.
+    Пул — глобальный объект модуля, поэтому перенаправляем его на временный файл
+    и пересоздаём локи (они привязываются к циклу событий).
+    """
+    pool.path = str(tmp_path / "test.sqlite3")
+    pool._writer_lock = asyncio.Lock()
+    pool._open_lock = asyncio.Lock()
+
+    def runner(coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await close_db()
+
+        return asyncio.run(main())
+
+    return runner
@@ -0,0 +1,160 @@
+from datetime import timedelta
+
+import httpx
+import pytest
+
+import server
+from changes import CHANGE_CREATE, CHANGE_DELETE, CHANGE_UPDATE, change_bus, compact_change_log, record_change
+from core import make_chat_sig, now_tz, to_epoch
+from db_pool import pool, init_db
+
+CHAT_ID = -1001
+SIG = make_chat_sig(CHAT_ID)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    # кэши модуля server переживают тест, а БД у каждого теста своя
+    server.upcoming_cache.clear()
+    server.feed_cache.clear()
+
+
+def _client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test")
+
+
+async def _changes(client: httpx.AsyncClient, **params) -> dict:
+    resp = await client.get("/api/calendar/changes", params={"chat_id": CHAT_ID, "sig": SIG, **params})
+    assert resp.status_code == 200, resp.text
+    return resp.json()
+
+
+async def _create(title: str, days: float) -> int:
+    dt = now_tz() + timedelta(days=days)
+    async with pool.connection(write=True) as db:
+        cur = await db.execute(
+            "INSERT INTO events(chat_id, poll_id, poll_message_id, creator_user_id, dt_iso, dt_utc_epoch, title, "
+            "cost, location, details, created_at_iso, updated_at_epoch) VALUES (?, ?, 1, 7, ?, ?, ?, '', '', '', ?, 0)",
+            (CHAT_ID, f"poll-{title}", dt.isoformat(), to_epoch(dt), title, now_tz().isoformat()),
+        )
+        event_id = cur.lastrowid
+        await cur.close()
+        change = await record_change(db, CHAT_ID, event_id, CHANGE_CREATE)
+        await db.commit()
+    change_bus.publish(change)
+    return event_id
+
+
+async def _rename(event_id: int, title: str):
+    async with pool.connection(write=True) as db:
+        await db.execute("UPDATE events SET title=? WHERE id=?", (title, event_id))
+        change = await record_change(db, CHAT_ID, event_id, CHANGE_UPDATE)
+        await db.commit()
+    change_bus.publish(change)
+
+
+async def _delete(event_id: int):
+    async with pool.connection(write=True) as db:
+        await db.execute("DELETE FROM events WHERE id=?", (event_id,))
+        change = await record_change(db, CHAT_ID, event_id, CHANGE_DELETE)
+        await db.commit()
+    change_bus.publish(change)
+
+
+def test_first_load_is_reset_then_delta_is_empty(run):
+    async def scenario():
+        await init_db()
+        first = await _create("A", 1)
+        second = await _create("B", 2)
+        async with _client() as client:
+            full = await _changes(client)
+            assert full["reset"] is True
+            assert [item["title"] for item in full["items"]] == ["A", "B"]
+            assert full["window"] == [first, second]
+
+            delta = await _changes(client, since=full["version"])
+            assert delta["reset"] is False
+            assert (delta["items"], delta["deleted"]) == ([], [])
+            assert delta["version"] == full["version"]
+
+    run(scenario())
+
+
+def test_delta_reports_created_updated_and_deleted(run):
+    async def scenario():
+        await init_db()
+        kept = await _create("A", 1)
+        renamed = await _create("B", 2)
+        removed = await _create("C", 3)
+        async with _client() as client:
+            since = (await _changes(client))["version"]
+            await _rename(renamed, "B2")
+            await _delete(removed)
+            added = await _create("D", 4)
+
+            delta = await _changes(client, since=since)
+            assert delta["reset"] is False
+            assert [(item["id"], item["title"]) for item in delta["items"]] == [(renamed, "B2"), (added, "D")]
+            assert delta["deleted"] == [removed]
+            assert delta["window"] == [kept, renamed, added]
+            assert delta["version"] > since
+
+    run(scenario())
+
+
+def test_unknown_or_compacted_since_resets(run):
+    async def scenario():
+        await init_db()
+        await _create("A", 1)
+        async with _client() as client:
+            since = (await _changes(client))["version"]
+            assert (await _changes(client, since=since + 100))["reset"] is True
+
+            await _create("B", 2)
+            # записи журнала старше «будущего» — все; log_floor сдвигается на их последний seq
+            await compact_change_log(retention=-3600)
+            stale = await _changes(client, since=since)
+            assert stale["reset"] is True
+            assert [item["title"] for item in stale["items"]] == ["A", "B"]
+
+            # с актуальной позиции после компактизации — обычная (пустая) дельта
+            fresh = await _changes(client, since=stale["version"])
+            assert fresh["reset"] is False
+            assert fresh["items"] == []
+
+    run(scenario())
+
+
+def test_limit_applies_to_reset_and_delta(run):
+    async def scenario():
+        await init_db()
+        first = await _create("A", 1)
+        second = await _create("B", 2)
+        third = await _create("C", 3)
+        async with _client() as client:
+            full = await _changes(client, limit=2)
+            assert full["window"] == [first, second]
+            assert len(full["items"]) == 2
+
+            await _rename(third, "C2")
+            await _rename(first, "A2")
+            delta = await _changes(client, since=full["version"], limit=2)
+            # событие за пределами окна в items не попадает, клиенту оно не нужно
+            assert [item["id"] for item in delta["items"]] == [first]
+            assert delta["deleted"] == [third]
+            assert delta["window"] == [first, second]
+
+    run(scenario())
+
+
+def test_past_events_leave_the_window(run):
+    async def scenario():
+        await init_db()
+        await _create("old", -2)
+        upcoming = await _create("new", 1)
+        async with _client() as client:
+            full = await _changes(client)
+            assert full["window"] == [upcoming]
+            assert [item["title"] for item in full["items"]] == ["new"]
+
+    run(scenario())
@@ -0,0 +1,61 @@
+from core import now_epoch
+from db_pool import pool, init_db
+from lease import Lease
+
+
+async def _holder(name: str):
+    async with pool.connection() as db:
+        cur = await db.execute("SELECT holder, expires_at_epoch FROM leases WHERE name=?", (name,))
+        row = await cur.fetchone()
+        await cur.close()
+    return row
+
+
+def test_only_one_holder_until_expiry(run):
+    a = Lease("scheduler", 30, holder="a")
+    b = Lease("scheduler", 30, holder="b")
+
+    async def scenario():
+        await init_db()
+        assert await a.try_acquire()
+        assert not await b.try_acquire()
+        # владелец продлевает свою аренду
+        assert await a.try_acquire()
+        holder, expires_at = await _holder("scheduler")
+        assert holder == "a"
+        assert expires_at >= now_epoch() + 29
+
+        async with pool.connection(write=True) as db:
+            await db.execute("UPDATE leases SET expires_at_epoch=? WHERE name='scheduler'", (now_epoch() - 1,))
+            await db.commit()
+        # истёкшую аренду забирает другой, прежний владелец её больше не продлит
+        assert await b.try_acquire()
+        assert not await a.try_acquire()
+        assert (await _holder("scheduler"))[0] == "b"
+
+    run(scenario())
+
+
+def test_release_hands_lease_over_at_once(run):
+    a = Lease("scheduler", 30, holder="a")
+    b = Lease("scheduler", 30, holder="b")
+
+    async def scenario():
+        await init_db()
+        assert await a.try_acquire()
+        # чужой release не снимает аренду
+        await b.release()
+        assert not await b.try_acquire()
+        await a.release()
+        assert await b.try_acquire()
+
+    run(scenario())
+
+
+def test_leases_are_independent_by_name(run):
+    async def scenario():
+        await init_db()
+        assert await Lease("scheduler", 30, holder="a").try_acquire()
+        assert await Lease("compactor", 30, holder="b").try_acquire()
+
+    run(scenario())
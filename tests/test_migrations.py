@@ -0,0 +1,80 @@
+import aiosqlite
+
+from db_pool import pool, init_db
+from db_schema import CREATE_SQL, MIGRATIONS
+
+
+async def _columns(db, table: str) -> set[str]:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    rows = await cur.fetchall()
+    await cur.close()
+    return {row[1] for row in rows}
+
+
+async def _scalar(db, sql: str, params=()):
+    cur = await db.execute(sql, params)
+    row = await cur.fetchone()
+    await cur.close()
+    return row[0] if row else None
+
+
+def test_fresh_database_gets_every_migration(run):
+    async def scenario():
+        await init_db()
+        async with pool.connection() as db:
+            assert await _scalar(db, "PRAGMA user_version") == len(MIGRATIONS)
+            assert {"dt_utc_epoch", "revision", "updated_at_epoch"} <= await _columns(db, "events")
+            assert {"run_at_epoch", "claimed_by", "claimed_until"} <= await _columns(db, "reminders")
+            assert {"claimed_by", "claimed_until", "generation"} <= await _columns(db, "outbox")
+            assert {"version", "vote_version", "log_floor"} <= await _columns(db, "chat_versions")
+            assert await _columns(db, "leases") == {"name", "holder", "expires_at_epoch"}
+            assert "seq" in await _columns(db, "change_log")
+
+    run(scenario())
+
+
+def test_baseline_database_is_migrated_with_backfill(run):
+    async def scenario():
+        # база в том виде, в каком её оставляла версия без миграций
+        async with aiosqlite.connect(pool.path) as db:
+            await db.executescript(CREATE_SQL)
+            await db.execute(
+                "INSERT INTO events(chat_id, poll_id, poll_message_id, creator_user_id, dt_iso, title, cost, "
+                "location, details, created_at_iso) VALUES (-100, 'p1', 10, 7, '2030-05-01T19:30:00+03:00', "
+                "'Quiz', '500', 'Bar', '', '2030-04-20T12:00:00+03:00')"
+            )
+            await db.execute(
+                "INSERT INTO reminders(event_id, kind, run_at_iso, sent) VALUES (1, 'yes_3h', '2030-05-01T16:30:00+03:00', 0)"
+            )
+            await db.commit()
+
+        await init_db()
+        async with pool.connection() as db:
+            assert await _scalar(db, "PRAGMA user_version") == len(MIGRATIONS)
+            # 19:30 по Москве — 16:30 UTC
+            assert await _scalar(db, "SELECT dt_utc_epoch FROM events WHERE id=1") == 1903883400
+            assert await _scalar(db, "SELECT run_at_epoch FROM reminders WHERE id=1") == 1903872600
+            assert await _scalar(db, "SELECT version FROM chat_versions WHERE chat_id=-100") == 1
+            # created_at_iso: 12:00 по Москве — 09:00 UTC
+            assert await _scalar(db, "SELECT updated_at_epoch FROM events WHERE id=1") == 1902906000
+            assert await _scalar(db, "SELECT revision FROM events WHERE id=1") == 0
+
+    run(scenario())
+
+
+def test_init_db_is_idempotent(run):
+    async def scenario():
+        await init_db()
+        async with pool.connection(write=True) as db:
+            await db.execute(
+                "INSERT INTO events(chat_id, poll_id, poll_message_id, dt_iso, dt_utc_epoch, title, cost, location, "
+                "created_at_iso) VALUES (1, 'p', 1, '2030-01-01T00:00:00+00:00', 1893456000, 't', '', '', "
+                "'2030-01-01T00:00:00+00:00')"
+            )
+            await db.commit()
+        await init_db()
+        async with pool.connection() as db:
+            assert await _scalar(db, "PRAGMA user_version") == len(MIGRATIONS)
+            assert await _scalar(db, "SELECT COUNT(*) FROM events") == 1
+
+    run(scenario())
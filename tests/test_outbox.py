@@ -0,0 +1,145 @@
+from core import now_epoch
+from db_pool import pool, init_db
+from outbox import Outbox
+
+
+class PermanentError(Exception):
+    pass
+
+
+def make_outbox(calls: list) -> Outbox:
+    box = Outbox(
+        max_attempts=2,
+        backoff_base=10,
+        backoff_max=60,
+        concurrency=2,
+        claim_ttl=30,
+        permanent_errors=(PermanentError,),
+    )
+
+    @box.handler("ok")
+    async def ok(bot, payload):
+        calls.append(("ok", payload["n"]))
+
+    @box.handler("flaky")
+    async def flaky(bot, payload):
+        calls.append(("flaky", payload["n"]))
+        raise RuntimeError("temporary")
+
+    @box.handler("gone")
+    async def gone(bot, payload):
+        calls.append(("gone", payload["n"]))
+        raise PermanentError("message deleted")
+
+    return box
+
+
+async def _rows(sql: str, params=()):
+    async with pool.connection() as db:
+        cur = await db.execute(sql, params)
+        rows = await cur.fetchall()
+        await cur.close()
+    return rows
+
+
+async def _enqueue(box: Outbox, kind: str, payload: dict, dedup_key=None, delay: int = 0):
+    async with pool.connection(write=True) as db:
+        await box.enqueue(db, kind, payload, dedup_key=dedup_key, delay=delay)
+        await db.commit()
+
+
+def test_done_action_is_deleted(run):
+    calls = []
+    box = make_outbox(calls)
+
+    async def scenario():
+        await init_db()
+        await _enqueue(box, "ok", {"n": 1})
+        assert await box.process_due(None) == 1
+        assert calls == [("ok", 1)]
+        assert await _rows("SELECT * FROM outbox") == []
+        assert box.stats() == {"executed": 1, "retried": 0, "failed": 0}
+
+    run(scenario())
+
+
+def test_transient_error_is_retried_with_backoff_then_gives_up(run):
+    calls = []
+    box = make_outbox(calls)
+
+    async def scenario():
+        await init_db()
+        await _enqueue(box, "flaky", {"n": 1})
+        before = now_epoch()
+        assert await box.process_due(None) == 1
+        [(attempts, next_at, failed, error, claimed_by)] = await _rows(
+            "SELECT attempts, next_attempt_epoch, failed, last_error, claimed_by FROM outbox"
+        )
+        assert (attempts, failed, claimed_by) == (1, 0, None)
+        assert next_at >= before + 10
+        assert error == "RuntimeError: temporary"
+
+        # пауза ещё не прошла — действие не берётся
+        assert await box.process_due(None) == 0
+
+        async with pool.connection(write=True) as db:
+            await db.execute("UPDATE outbox SET next_attempt_epoch=?", (now_epoch(),))
+            await db.commit()
+        assert await box.process_due(None) == 1
+        # max_attempts=2: вторая неудача — окончательная
+        assert await _rows("SELECT attempts, failed FROM outbox") == [(2, 1)]
+        assert await box.process_due(None) == 0
+        assert calls == [("flaky", 1), ("flaky", 1)]
+        assert box.stats() == {"executed": 0, "retried": 1, "failed": 1}
+
+    run(scenario())
+
+
+def test_permanent_error_fails_at_once(run):
+    calls = []
+    box = make_outbox(calls)
+
+    async def scenario():
+        await init_db()
+        await _enqueue(box, "gone", {"n": 1})
+        assert await box.process_due(None) == 1
+        assert await _rows("SELECT attempts, failed, last_error FROM outbox") == [
+            (1, 1, "PermanentError: message deleted")
+        ]
+        assert box.stats() == {"executed": 0, "retried": 0, "failed": 1}
+
+    run(scenario())
+
+
+def test_dedup_key_replaces_pending_action(run):
+    calls = []
+    box = make_outbox(calls)
+
+    async def scenario():
+        await init_db()
+        await _enqueue(box, "ok", {"n": 1}, dedup_key="edit_card:1")
+        await _enqueue(box, "ok", {"n": 2}, dedup_key="edit_card:1")
+        assert await box.process_due(None) == 1
+        assert calls == [("ok", 2)]
+
+    run(scenario())
+
+
+def test_action_claimed_by_another_worker_is_skipped(run):
+    calls = []
+    box = make_outbox(calls)
+
+    async def scenario():
+        await init_db()
+        await _enqueue(box, "ok", {"n": 1})
+        await _enqueue(box, "ok", {"n": 2})
+        async with pool.connection(write=True) as db:
+            await db.execute(
+                "UPDATE outbox SET claimed_by='other', claimed_until=? WHERE id=1", (now_epoch() + 30,)
+            )
+            await db.commit()
+        assert await box.process_due(None) == 1
+        assert calls == [("ok", 2)]
+        assert await _rows("SELECT id, claimed_by FROM outbox") == [(1, "other")]
+
+    run(scenario())
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+from typing import Optional
+
+from core import VOTE_FLUSH_MS, VOTE_FLUSH_MAX, now_tz
+from db_pool import pool
+from changes import record_vote_changes, change_bus
+
+
+class VoteBuffer:
+    """
+    Write-behind буфер ответов на опросы: голоса копятся в памяти и пишутся одной транзакцией
+    раз в flush_interval или при накоплении max_pending голосов. Для пары (poll_id, user_id)
+    побеждает последний голос. Голоса за чужие опросы отсекаются при записи (EXISTS по events).
+    """
+
+    def __init__(self, flush_interval: float, max_pending: int):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # user_id -> poll_id -> (option_id, updated_at_iso)
+        self._votes: dict[int, dict[str, tuple[Optional[int], str]]] = {}
+        # user_id -> (poll_id, username, first_name, last_name, updated_at_iso)
+        self._users: dict[int, tuple] = {}
+        # пачка, которая сейчас пишется в БД — тоже видна читателям
+        self._flushing: dict[int, dict[str, tuple[Optional[int], str]]] = {}
+        self._pending = 0
+        self._flush_lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+
+        self.added = 0
+        self.flushes = 0
+        self.flushed_votes = 0
+
+    def add(self, poll_id: str, user_id: int, option_id: Optional[int], username, first_name, last_name):
+        updated_at = now_tz().isoformat()
+        polls = self._votes.setdefault(user_id, {})
+        if poll_id not in polls:
+            self._pending += 1
+        polls[poll_id] = (option_id, updated_at)
+        self._users[user_id] = (poll_id, username, first_name, last_name, updated_at)
+        self.added += 1
+
+        if self._pending >= self.max_pending:
+            self._spawn(0)
+        elif self._timer is None or self._timer.done():
+            self._timer = self._spawn(self.flush_interval)
+
+    def _spawn(self, delay: float) -> asyncio.Task:
+        task = asyncio.create_task(self._flush_later(delay))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _flush_later(self, delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            await self.flush()
+        except Exception:
+            pass  # уже залогировано, пачка возвращена в буфер
+
+    def pending_for_user(self, user_id: int) -> dict[str, Optional[int]]:
+        pending = {poll_id: option_id for poll_id, (option_id, _) in self._flushing.get(user_id, {}).items()}
+        pending.update((poll_id, option_id) for poll_id, (option_id, _) in self._votes.get(user_id, {}).items())
+        return pending
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            votes, users = self._votes, self._users
+            self._votes, self._users, self._pending = {}, {}, 0
+            self._flushing = votes
+
+            vote_rows = [
+                (poll_id, user_id, option_id, updated_at, poll_id)
+                for user_id, polls in votes.items()
+                for poll_id, (option_id, updated_at) in polls.items()
+            ]
+            user_rows = [
+                (user_id, username, first_name, last_name, updated_at, poll_id)
+                for user_id, (poll_id, username, first_name, last_name, updated_at) in users.items()
+            ]
+            try:
+                async with pool.connection(write=True) as db:
+                    await db.executemany(
+                        "INSERT INTO votes(poll_id, user_id, option_id, updated_at_iso) "
+                        "SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM events WHERE poll_id=?) "
+                        "ON CONFLICT(poll_id, user_id) DO UPDATE SET option_id=excluded.option_id, "
+                        "updated_at_iso=excluded.updated_at_iso",
+                        vote_rows,
+                    )
+                    await db.executemany(
+                        "INSERT INTO users(user_id, username, first_name, last_name, updated_at_iso) "
+                        "SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM events WHERE poll_id=?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET username=excluded.username, first_name=excluded.first_name, "
+                        "last_name=excluded.last_name, updated_at_iso=excluded.updated_at_iso",
+                        user_rows,
+                    )
+                    changes = await record_vote_changes(db, [(row[0], row[1]) for row in vote_rows])
+                    await db.commit()
+            except Exception:
+                logging.exception("vote buffer flush failed: votes=%s", len(vote_rows))
+                self._restore(votes, users)
+                raise
+            finally:
+                self._flushing = {}
+
+            self.flushes += 1
+            self.flushed_votes += len(vote_rows)
+            for change in changes:
+                change_bus.publish(change)
+
+    def _restore(self, votes: dict, users: dict):
+        # возвращаем неудачную пачку в буфер, не затирая голоса, пришедшие во время записи
+        for user_id, polls in votes.items():
+            current = self._votes.setdefault(user_id, {})
+            for poll_id, vote in polls.items():
+                if poll_id not in current:
+                    current[poll_id] = vote
+                    self._pending += 1
+        for user_id, user in users.items():
+            self._users.setdefault(user_id, user)
+        self._timer = self._spawn(self.flush_interval)
+
+    async def close(self):
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._pending,
+            "added": self.added,
+            "flushes": self.flushes,
+            "flushed_votes": self.flushed_votes,
+        }
+
+
+vote_buffer = VoteBuffer(VOTE_FLUSH_MS / 1000.0, VOTE_FLUSH_MAX)
@@ -0,0 +1,83 @@
+import asyncio
+import hmac
+import logging
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import Response
+
+from core import WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET
+
+
+class WebhookReceiver:
+    """
+    Приём апдейтов Telegram через webhook на общем FastAPI-приложении.
+    Проверяем X-Telegram-Bot-Api-Secret-Token и сразу отвечаем 200,
+    а сам апдейт обрабатывается диспетчером в отдельной задаче.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str = WEBHOOK_SECRET):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self._tasks: set[asyncio.Task] = set()
+        self.received = 0
+        self.rejected = 0
+        self.malformed = 0
+        self.failed = 0
+
+    def mount(self, app: FastAPI, path: str = WEBHOOK_PATH):
+        async def telegram_webhook(
+            request: Request,
+            secret_token: str = Header(default="", alias="X-Telegram-Bot-Api-Secret-Token"),
+        ):
+            if not hmac.compare_digest(secret_token, self.secret):
+                self.rejected += 1
+                raise HTTPException(401, "bad secret token")
+            try:
+                update = Update.model_validate(await request.json(), context={"bot": self.bot})
+            except ValueError as e:
+                # битое тело (не JSON, не Update): на 5xx Telegram повторял бы его бесконечно — отвечаем 200
+                self.malformed += 1
+                logging.warning("webhook: malformed update dropped: %s", type(e).__name__)
+                return Response(status_code=200)
+            self.received += 1
+            task = asyncio.create_task(self._feed(update))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return Response(status_code=200)
+
+        app.add_api_route(path, telegram_webhook, methods=["POST"], include_in_schema=False)
+
+    async def _feed(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            self.failed += 1
+            logging.exception("webhook update failed: update_id=%s", update.update_id)
+
+    async def register(self, base_url: str = WEBHOOK_BASE_URL, path: str = WEBHOOK_PATH):
+        if not base_url:
+            raise RuntimeError("Set WEBHOOK_BASE_URL (or API_BASE_URL) for BOT_MODE=webhook")
+        url = base_url.rstrip("/") + path
+        await self.bot.set_webhook(
+            url,
+            secret_token=self.secret,
+            allowed_updates=self.dp.resolve_used_update_types(),
+        )
+        logging.info("webhook registered: url=%s", url)
+
+    async def close(self):
+        # даём дообработаться уже принятым апдейтам
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received,
+            "rejected": self.rejected,
+            "malformed": self.malformed,
+            "failed": self.failed,
+            "in_flight": len(self._tasks),
+        }